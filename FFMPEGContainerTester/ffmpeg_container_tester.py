@@ -4,10 +4,8 @@ by using bruteforce with FFMPEG.
 Usage: Lauch this script, type container when prompted, watch
 codecs being tried one by one and find report file after execution.
 
-Note: ffmpeg may hang on some codecs. Symptom: Encoding takes more than
-15-30 seconds AND checking output temporary file's properties shows it
-is small (<1ko) and doesn't grow. You may kill its process using
-task manager or equivalent.
+Note: ffmpeg may hang on some codecs, so encoding attempts are killed after
+FFMPEG_TIMEOUT seconds; such codecs are listed in a separate report (`*.timeout.json`).
 
 WARNING: The list of "compatible codecs" produced likely is incomplete
 because of the limitations of FFMPEG, which can't encode to any format.
@@ -30,14 +28,23 @@ You can get sample video files from :
 
 import argparse
 import json
+import os
+import shutil
 import subprocess
-from typing import Iterable, Dict
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Iterable, Dict, Optional, Union
 from pathlib import Path
 
 FFMPEG_CALL = [
     'ffmpeg',
     '-y', # overwrite files
-    '-loglevel', 'warning',
+    '-loglevel', 'warning'
+]
+FFMPEG_FALLBACK_PROBE_PARAMS = [
     '-probesize', '100G',
     '-analyzeduration', '100G'
 ]
@@ -50,66 +57,102 @@ FFMPEG_PATCH_ENCODER = {
     'dvd_subtitle': 'dvdsub'
 }
 
+FFMPEG_TIMEOUT = { # by codec type, in seconds
+    'video': 60,
+    'audio': 30,
+    'subtitle': 30
+}
+
 SCRIPT_PATH = Path(__file__).resolve().parent
+FFMPEG_CODECS_CACHE = Path(tempfile.gettempdir()) / 'ffmpeg_container_tester_codecs.json'
 
-def execute( command: Iterable[str], shell: bool = False, timeout: int = None ) -> Dict[str,str]:
+def execute( command: Iterable[str], shell: bool = False, timeout: int = None, decode: bool = True ) -> Dict[str,Union[str,bytes]]:
     ''' Passes command to subprocess.Popen, retrieves stdout/stderr and performs
     error management.
-    Returns a dictionnary containing stdX.
+    Returns a dictionnary containing stdX (as bytes if `decode` is False) and
+    whether the process was killed after `timeout` seconds.
     Upon command failure, prints exception and returns empty dict. '''
 
     PIPE = subprocess.PIPE
+    timed_out = False
     with subprocess.Popen( command, stdout=PIPE, stderr=PIPE, shell=shell ) as process:
         # wait and retrieve stdout/err
         try:
             _stdout, _stderr = process.communicate(timeout=timeout)
         except subprocess.TimeoutExpired:
-            print("Caught TimeoutExpired")
             process.kill()
-            print("Killed process")
             _stdout, _stderr = process.communicate()
+            timed_out = True
 
+        if not decode:
+            return { 'stdout': _stdout, 'stderr': _stderr, 'timeout': timed_out }
         # handle text encoding issues and return stdX
         return {
             'stdout': _stdout.decode('utf8', errors='backslashreplace'),
-            'stderr': _stderr.decode('utf8', errors='backslashreplace')
+            'stderr': _stderr.decode('utf8', errors='backslashreplace'),
+            'timeout': timed_out
         }
 
 
+@lru_cache(maxsize=None)
+def get_ffmpeg_codecs_raw() -> str:
+    ''' Returns the output of `ffmpeg -codecs`. It is cached in FFMPEG_CODECS_CACHE, keyed
+    by the ffmpeg binary's path, modification time and size.
+    '''
+    ffmpeg_binary = shutil.which('ffmpeg')
+    if ffmpeg_binary is None:
+        return execute( ['ffmpeg', '-codecs'] )['stdout']
+    _stat = Path(ffmpeg_binary).stat()
+    binary_key = f"{ffmpeg_binary}|{_stat.st_mtime_ns}|{_stat.st_size}"
+
+    if FFMPEG_CODECS_CACHE.is_file():
+        try:
+            cache = json.loads(FFMPEG_CODECS_CACHE.read_text(encoding='utf8'))
+        except (OSError, ValueError): # unreadable or not JSON (json.JSONDecodeError is a ValueError)
+            cache = None
+        if isinstance(cache, dict) and cache.get('binary')==binary_key and isinstance(cache.get('codecs'), str):
+            return cache['codecs']
+
+    ffmpeg_codecs_raw = execute( ['ffmpeg', '-codecs'] )['stdout']
+    # written to a temporary file first, so concurrent/interrupted runs can't leave a truncated cache
+    tmp_cache = FFMPEG_CODECS_CACHE.with_name(f'{FFMPEG_CODECS_CACHE.name}.{os.getpid()}.tmp')
+    tmp_cache.write_text(
+        json.dumps({'binary': binary_key, 'codecs': ffmpeg_codecs_raw}),
+        encoding='utf8'
+    )
+    os.replace(tmp_cache, FFMPEG_CODECS_CACHE)
+    return ffmpeg_codecs_raw
+
+
 def get_ffmpeg_codecs() -> dict:
     ''' Retrieves codecs fully supported by FFMPEG (encoding and decoding)
     Returns them by category.
     '''
-    ffmpeg_codecs_raw = execute( ['ffmpeg', '-codecs'] )['stdout']
+    ffmpeg_codecs_raw = get_ffmpeg_codecs_raw()
     assert ffmpeg_codecs_raw
 
-    codec_type = lambda x: 'video' if 'V' in x else ('audio' if 'A' in x else ('subtitle' if 'S' in x else None))
-    ffmpeg_codecs = {
-        line_items[1]: codec_type(line_items[0])
-        for line_items in [
-            line.split()
-            for line in ffmpeg_codecs_raw.splitlines()
-        ]
-        if line_items[0].startswith('DE') and codec_type(line_items[0])
-    }
-    ffmpeg_codecs_by_type = {
-        _type: [
-            _codec
-            for _codec, _codec_type in ffmpeg_codecs.items()
-            if _codec_type==_type
-        ]
-        for _type in set(ffmpeg_codecs.values())
-    }
-    return ffmpeg_codecs_by_type
+    # Flags are like 'DEV.LS': decoding, encoding, type (Video/Audio/Subtitle/Data/aTtachment), ...
+    codec_types = { 'V': 'video', 'A': 'audio', 'S': 'subtitle' }
+    ffmpeg_codecs_by_type = defaultdict(list)
+    for line in ffmpeg_codecs_raw.splitlines():
+        line_items = line.split()
+        if len(line_items) < 2 or not line_items[0].startswith('DE'):
+            continue
+        _codec_type = codec_types.get(line_items[0][2:3])
+        if _codec_type:
+            ffmpeg_codecs_by_type[_codec_type].append(line_items[1])
+    return dict(ffmpeg_codecs_by_type)
 
 
-def ffmpeg_try_encoding( file: Path, codec: str, codec_type: str, _format: str, allow_experimental: bool = False, stream_idx: int = 0 ) -> bool:
+def ffmpeg_try_encoding( file: Path, codec: str, codec_type: str, _format: str, allow_experimental: bool = False, stream_idx: int = 0, deep_probe: bool = False ) -> Optional[bool]:
     ''' Tries to launch conversion with FFMPEG targeting a specific format and codec.
-    Returns whether or not FFMPEG can produce the file.
+    Returns whether or not FFMPEG can produce the file, or None if FFMPEG timed out.
 
-    Note: for performance reasons, only encodes first 10 seconds on audio/video codecs
+    Note: for performance reasons, only encodes first 10 seconds on audio/video codecs.
+    Input is only deeply probed if ffmpeg can't find stream parameters in the file's header.
+    Output file is specific to the calling process and thread, so calls may run concurrently.
     '''
-    out_file = file.with_suffix(f".{codec_type}.{codec}.{_format}")
+    out_file = file.with_suffix(f".{codec_type}.{codec}.{os.getpid()}.{threading.get_ident()}.{_format}")
     if out_file.is_file():
         out_file.unlink()
 
@@ -134,6 +177,7 @@ def ffmpeg_try_encoding( file: Path, codec: str, codec_type: str, _format: str,
     }
 
     cmd = FFMPEG_CALL + \
+        (FFMPEG_FALLBACK_PROBE_PARAMS if deep_probe else []) + \
         [ '-i', file ] + \
         (['-strict','-2'] if allow_experimental else []) + \
         additional_parameters.get(codec,[]) + \
@@ -142,17 +186,24 @@ def ffmpeg_try_encoding( file: Path, codec: str, codec_type: str, _format: str,
             '-c', FFMPEG_PATCH_ENCODER.get(codec,codec),
             out_file
         ]
-    stdX = execute(cmd)
+    stdX = execute(cmd, timeout=FFMPEG_TIMEOUT.get(codec_type), decode=False)
     encoding_works = out_file.is_file() and out_file.stat().st_size > 1_000
-    out_file.unlink()
+    if out_file.is_file():
+        out_file.unlink()
+    if stdX['timeout']:
+        return None
     if not encoding_works:
-        if 'Subtitle encoding currently only possible from text to text or bitmap to bitmap' in stdX['stderr']:
-            return ffmpeg_try_encoding( file, codec, codec_type, _format, stream_idx=1 )
-        if "add '-strict -2'" in stdX['stderr']:
-            return ffmpeg_try_encoding( file, codec, codec_type, _format, allow_experimental=True )
-        if not any(x in stdX['stderr'] for x in ['is not supported by this format','codec not currently supported in container','No wav codec tag found for codec']):
+        stderr = stdX['stderr'].decode('utf8', errors='backslashreplace')
+        # retries keep the flags accumulated by previous retries, and each flag is only tried once
+        if 'Could not find codec parameters' in stderr and not deep_probe:
+            return ffmpeg_try_encoding( file, codec, codec_type, _format, allow_experimental, stream_idx, deep_probe=True )
+        if 'Subtitle encoding currently only possible from text to text or bitmap to bitmap' in stderr and stream_idx==0:
+            return ffmpeg_try_encoding( file, codec, codec_type, _format, allow_experimental, stream_idx=1, deep_probe=deep_probe )
+        if "add '-strict -2'" in stderr and not allow_experimental:
+            return ffmpeg_try_encoding( file, codec, codec_type, _format, allow_experimental=True, stream_idx=stream_idx, deep_probe=deep_probe )
+        if not any(x in stderr for x in ['is not supported by this format','codec not currently supported in container','No wav codec tag found for codec']):
             print(cmd)
-            print(f">{codec}: stderr: {stdX['stderr']}", end='')
+            print(f">{codec}: stderr: {stderr}", end='')
     return encoding_works
 
 
@@ -164,6 +215,13 @@ def get_args() -> argparse.Namespace:
         action='store',
         help='Test file with at least one video, audio and subtitle stream.'
     )
+    parser.add_argument(
+        '--jobs',
+        action='store',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of codecs tested in parallel (default: number of CPUs).'
+    )
     return parser.parse_args()
 
 
@@ -181,20 +239,34 @@ def main() -> None:
         c_type = input("Codec type [video,audio,subtitle,all]: ")
 
     compatible_codecs = { codec_type:list() for codec_type in ffmpeg_codecs_by_type }
-    for codec_type, _codecs in ffmpeg_codecs_by_type.items():
-        if codec_type!=c_type and c_type!='all':
-            continue
-        print(f"FFMPEG {codec_type} codecs:")
-        for _codec in _codecs:
-            codec_is_compatible = ffmpeg_try_encoding(
-                file=test_file,
-                codec=_codec,
-                codec_type=codec_type,
-                _format=_format
-            )
-            print(f">{_codec}: {codec_is_compatible}")
-            if codec_is_compatible:
-                compatible_codecs[codec_type].append(_codec)
+    timed_out_codecs = { codec_type:list() for codec_type in ffmpeg_codecs_by_type } # reported separately
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        # Submit all tests at once, then collect results in codec order
+        tests = {
+            codec_type: [
+                (_codec, executor.submit(
+                    ffmpeg_try_encoding,
+                    file=test_file,
+                    codec=_codec,
+                    codec_type=codec_type,
+                    _format=_format
+                ))
+                for _codec in _codecs
+            ]
+            for codec_type, _codecs in ffmpeg_codecs_by_type.items()
+            if codec_type==c_type or c_type=='all'
+        }
+        for codec_type, _tests in tests.items():
+            print(f"FFMPEG {codec_type} codecs:")
+            for _codec, test in _tests:
+                codec_is_compatible = test.result()
+                if codec_is_compatible is None:
+                    print(f">{_codec}: timeout")
+                    timed_out_codecs[codec_type].append(_codec)
+                    continue
+                print(f">{_codec}: {codec_is_compatible}")
+                if codec_is_compatible:
+                    compatible_codecs[codec_type].append(_codec)
 
     res_file = SCRIPT_PATH / f'compatibility_report_{_format}.{c_type}.json'
     res_file.write_text(
@@ -207,6 +279,18 @@ def main() -> None:
     )
     print(f"Results saved to {res_file}")
 
+    if any(timed_out_codecs.values()):
+        timeout_file = res_file.with_suffix('.timeout.json')
+        timeout_file.write_text(
+            json.dumps(
+                { codec_type:_codecs for codec_type, _codecs in timed_out_codecs.items() if _codecs },
+                indent=2
+            ),
+            encoding='utf8',
+            errors='ignore'
+        )
+        print(f"Codecs that timed out saved to {timeout_file}")
+
 
 if __name__=='__main__':
     main()
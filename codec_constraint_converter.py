@@ -1,4 +1,4 @@
-#pylint: disable=too-many-arguments, global-statement
+#pylint: disable=too-many-arguments
 ''' This module implements CodecConstraintConverter and associated tools. This is aimed at
 automating conversion of video files with FFMPEG, with flexible rules.
 
@@ -9,6 +9,8 @@ Interface:
   (see argument `format_rules`)
 - ``FFMPEGConvertStream``, ``FFMPEGExtractStream``, ``ExternalCommand``, ``DropStream``: Represent
   the different stackable stream actions accepted by CodecConstraintConverter's planning engine.
+- ``get_ffmpeg_encoders``, ``ffmpeg_encoder_works``, ``ffmpeg_encoder_test_command``: Used to check which
+  encoders ffmpeg can use.
 
 Note: The accompanying file ``format_compatibility.json`` is required, with entries
   <format:str>:<supported_codecs:List[str]>. See project FFMPEGContainerTester.
@@ -19,26 +21,111 @@ Refer to ``CodecConstraintConverter``'s documentation for details on parameters.
 '''
 
 import enum
+import hashlib
 import json
+import os
+import shutil
+import tempfile
+import time
 from collections import namedtuple
-from typing import Callable, List, Union, Dict, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Iterable, List, Union, Dict, Tuple, Set
 from pathlib import Path
+from types import MappingProxyType
 
-from utils import find_available_path, execute, dump_json, patch_string
+from utils import find_available_path, execute, dump_json, compile_patch, apply_patch, PatchContext
 from os_detect import Os
 
+try:
+    # Optional: faster JSON parsing (its errors subclass json.JSONDecodeError)
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+FORMAT_COMPATIBILITY_FILE = Path(__file__).parent / 'format_compatibility.json'
+assert FORMAT_COMPATIBILITY_FILE.is_file(), "ERROR: Could not load `format_compatibility.json`"
+FORMAT_COMPATIBILITY = MappingProxyType({ # <format:str>:<supported_codecs:FrozenSet[str]>, read-only
+    _format: frozenset(codecs)
+    for _format, codecs in json_loads(FORMAT_COMPATIBILITY_FILE.read_bytes()).items()
+})
+
 TODO = '''
 - Investigate menu duplication
 '''
 
 Command = List[Union[str,Path]]
 CodecRule = namedtuple(typename='CodecRule', field_names=['passthrough','convert'])
-FORMAT_COMPATIBILITY = {} # To be initialized at runtime
 DUMP_FFPROBE = False
+CODEC_TYPES = frozenset({ 'video', 'audio', 'subtitle', 'attachment' }) # streams of other types are ignored
+FFMPEG_CALL = (
+    'ffmpeg',
+    '-loglevel', 'warning',
+    '-stats'
+)
 DEBUG_REMUX = False
+FFMPEG_CAPABILITIES_CACHE = Path(tempfile.gettempdir()) / 'plex_optimizer_ffmpeg_caps.json'
+PROBE_PARAMS = ['-probesize', '5M', '-analyzeduration', '5M'] # ffprobe's defaults
+PROBE_FALLBACK_PARAMS = ['-probesize', '100G', '-analyzeduration', '100G']
+FFMPEG_INPUT_PARAMS = ['-probesize', '100G', '-analyzeduration', '100G'] # encodes/remuxes: A/V sync matters
+FFPROBE_ENTRIES = ':'.join([ # stream information used for planning (all of it is retrieved when DUMP_FFPROBE is set)
+    'stream=index,codec_type,codec_name,width,height,pix_fmt,channels',
+    'stream_tags=title,language,BPS,BPS-eng',
+    'stream_disposition=default,forced'
+])
+PROBE_CACHE_MAX_AGE = 30 * 24 * 3600 # seconds; older probe cache entries are discarded when read
+PROBE_REQUIRED_FIELDS = { # stream info needed for planning, by codec type
+    'video': ('codec_name', 'width', 'height'),
+    'audio': ('codec_name', 'channels'),
+    'subtitle': ('codec_name',)
+}
+
+
+# Script macros are single-item commands like `[MKDIR] "<dir>"`, translated by dialect
+SCRIPT_DIALECTS = {
+    'bat': {
+        'header': 'chcp 65001\n@echo off\n\n',
+        'macros': {
+            '[ASSERT_EXIST]': lambda arg: f'IF NOT EXIST "{arg}" ( ECHO Error: Missing file "{arg} !" ) ELSE ( ECHO File confirmed to exist )',
+            '[MKDIR]': lambda arg: f'MD {arg}',
+            '[RMDIR]': lambda arg: f'RD /S /Q {arg}',
+            '[MOVE]': lambda arg: f'MOVE /Y {arg}',
+            '[DEL]': lambda arg: f'DEL {arg}',
+            '[ECHO]': lambda arg: f'ECHO {arg}'
+        }
+    },
+    'sh': {
+        'header': '#!/bin/bash\n\n',
+        'macros': {
+            '[ASSERT_EXIST]': lambda arg: f'if [ -f "{arg}" ]; then echo "File confirmed to exist"; else echo "Error: Missing file {arg} !"; fi',
+            '[MKDIR]': lambda arg: f'mkdir {arg}',
+            '[RMDIR]': lambda arg: f'rm -rf {arg}',
+            '[MOVE]': lambda arg: f'mv -f {arg}',
+            '[DEL]': lambda arg: f'rm -f {arg}',
+            '[ECHO]': lambda arg: f'echo {arg}'
+        }
+    }
+}
+
+
+@lru_cache(maxsize=4096)
+def quote( c: Path ) -> str:
+    ''' Returns `c` as a double-quoted string. Cached: the same files appear in many commands
+    '''
+    return f'"{c}"'
+
+
+def patch_macro( c: Command, macros: Dict[str,Callable] ) -> Command:
+    ''' Translates `c` using `macros` if it is a macro, else returns it unchanged
+    '''
+    if len(c)==1 and isinstance(c[0], str) and c[0].startswith('['):
+        for macro, translate in macros.items():
+            if c[0].startswith(macro):
+                return [ translate(c[0][len(macro):].strip()) ]
+    return c
 
 
-class StreamAction(enum.Enum):
+class StreamAction(enum.IntEnum):
     ''' Represents the possible actions when converting a stream '''
     Convert  = 1
     Copy     = 2
@@ -47,23 +134,27 @@ class StreamAction(enum.Enum):
     Drop     = 5
 
 
-def FFMPEGConvertStream( codec: str, parameters: List = None, output_format: str = None, repr_complement: str = None ) -> dict:
+def FFMPEGConvertStream( codec: str, parameters: List = None, output_format: str = None, repr_complement: str = None, encoder: str = None ) -> dict:
     ''' Returns a partial stream-specific conversion command, with custom parameters.
     Use for both convert and copy of streams.
 
     `output_format`: Not used for streams whose plan is a single FFMPEGConvertStream
 
+    `encoder`: ffmpeg encoder to use instead of the default one for `codec` (eg: 'h264_nvenc')
+
     Convention: `in_file_idx`, `in_stream`, `out_stream` are FFMPEG-related indexes
         and `in_file`, `out_file` are Path representing input/output file
     '''
     if parameters is None:
         parameters = []
+    ffmpeg_stream_parameters = [
+        '-map', '{in_file_idx}:{in_stream}',
+        '-c:{out_stream}', codec if encoder is None else encoder
+    ] + parameters
     return {
         'action': StreamAction.Copy if codec=='copy' else StreamAction.Convert,
-        'ffmpeg_stream_parameters': [
-            '-map', '{in_file_idx}:{in_stream}',
-            '-c:{out_stream}', codec
-        ] + parameters,
+        'ffmpeg_stream_parameters': ffmpeg_stream_parameters,
+        'compiled_stream_parameters': [ compile_patch(s) for s in ffmpeg_stream_parameters ],
         'codec': codec,
         'repr': codec if repr_complement is None else codec+repr_complement,
         'output_format': output_format
@@ -79,12 +170,14 @@ def FFMPEGExtractStream( codec: str = 'copy', output_format: str = 'mkv', parame
     '''
     if parameters is None:
         parameters = []
+    ffmpeg_stream_parameters = [
+        '-map', '{in_file_idx}:{in_stream}',
+        '-c', codec
+    ] + parameters
     return {
         'action': StreamAction.Extract,
-        'ffmpeg_stream_parameters': [
-            '-map', '{in_file_idx}:{in_stream}',
-            '-c', codec
-        ] + parameters,
+        'ffmpeg_stream_parameters': ffmpeg_stream_parameters,
+        'compiled_stream_parameters': [ compile_patch(s) for s in ffmpeg_stream_parameters ],
         'codec': codec,
         'output_format': output_format,
         'repr': codec + ' (extract)'
@@ -101,6 +194,7 @@ def ExternalCommand( command: Command, output_codec: str, output_format: str, cu
     return {
         'action': StreamAction.External,
         'external_command': command,
+        'compiled_command': [ compile_patch(s) for s in command ],
         'codec': output_codec,
         'output_format': output_format,
         'repr': output_codec + ' (external)',
@@ -116,20 +210,77 @@ def DropStream() -> Callable:
     }
 
 
+@lru_cache(maxsize=None)
+def ffmpeg_capabilities( option: str ) -> str:
+    ''' Returns the output of ``ffmpeg -hide_banner <option>`` (eg: option='-encoders').
+    Outputs are cached in FFMPEG_CAPABILITIES_CACHE, keyed by the ffmpeg binary's path,
+    modification time and size, so ffmpeg only needs to run again when it is updated.
+    '''
+    ffmpeg_binary = shutil.which('ffmpeg')
+    if ffmpeg_binary is None:
+        return execute( ['ffmpeg', '-hide_banner', option], capture_stderr=False )['stdout']
+    _stat = Path(ffmpeg_binary).stat()
+    binary_key = f"{ffmpeg_binary}|{_stat.st_mtime_ns}|{_stat.st_size}"
+
+    cache = {}
+    if FFMPEG_CAPABILITIES_CACHE.is_file():
+        try:
+            cache = json.loads(FFMPEG_CAPABILITIES_CACHE.read_text(encoding='utf8'))
+        except (OSError, ValueError): # unreadable or not JSON (json.JSONDecodeError is a ValueError)
+            pass
+    if not isinstance(cache, dict) or cache.get('binary')!=binary_key or not isinstance(cache.get('outputs'), dict):
+        cache = {'binary': binary_key, 'outputs': {}}
+    if option not in cache['outputs']:
+        cache['outputs'][option] = execute( ['ffmpeg', '-hide_banner', option], capture_stderr=False )['stdout']
+        # written to a temporary file first, so concurrent/interrupted runs can't leave a truncated cache
+        tmp_cache = FFMPEG_CAPABILITIES_CACHE.with_name(f'{FFMPEG_CAPABILITIES_CACHE.name}.{os.getpid()}.tmp')
+        dump_json(cache, tmp_cache)
+        os.replace(tmp_cache, FFMPEG_CAPABILITIES_CACHE)
+    return cache['outputs'][option]
+
+
+def get_ffmpeg_encoders() -> Set[str]:
+    ''' Returns the names of the encoders ffmpeg was built with
+    '''
+    encoders, past_legend = set(), False
+    for line in ffmpeg_capabilities('-encoders').splitlines():
+        # Encoder lines (eg: " V....D libx264  libx264 H.264 ..") follow the legend, which ends with " ------"
+        if not past_legend:
+            past_legend = line.strip().startswith('---')
+            continue
+        line_items = line.split()
+        if len(line_items) > 1:
+            encoders.add(line_items[1])
+    return encoders
+
+
+def ffmpeg_encoder_test_command( encoder: str ) -> Command:
+    ''' Returns a ffmpeg command encoding a test frame with `encoder`; it works
+    iff its stderr is empty (see ffmpeg_encoder_works).
+    '''
+    return [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', 'color=c=black:s=256x256:d=0.1',
+        '-frames:v', '1', '-c:v', encoder,
+        '-f', 'null', '-'
+    ]
+
+
+def ffmpeg_encoder_works( encoder: str ) -> bool:
+    ''' Returns True if ffmpeg manages to encode a test frame with `encoder`.
+    Useful for hardware encoders, which may be built into ffmpeg without a matching device/driver.
+    '''
+    return execute( ffmpeg_encoder_test_command(encoder), decode=False )['stderr'] == b''
+
+
 class CodecConstraintConverter:
 
     ''' This object's purpose is to allow for automated
     rule-based video file conversion.
     '''
 
-    CODEC_TYPES = { 'video', 'audio', 'subtitle', 'attachment' }
-    FFMPEG_CALL = [
-            'ffmpeg',
-            '-loglevel', 'warning',
-            '-stats',
-            '-probesize', '100G',
-            '-analyzeduration', '100G'
-        ]
+    CODEC_TYPES = CODEC_TYPES
+    FFMPEG_CALL = FFMPEG_CALL
 
     def __init__(
         self,
@@ -138,7 +289,11 @@ class CodecConstraintConverter:
         conversion_rules: dict,
         keep_original_streams_rules: dict,
         drop_unknown_streams: bool = True,
-        bitrate_limit: Union[int,float] = float('inf')
+        bitrate_limit: Union[int,float] = float('inf'),
+        probe_cache_dir: Path = None,
+        probe_parameters: List[str] = None,
+        probe_fallback_parameters: List[str] = None,
+        ffmpeg_input_parameters: List[str] = None
     ) -> None:
         ''' Requires following parameters:
 
@@ -146,11 +301,14 @@ class CodecConstraintConverter:
 
         `format_rules`: An access to format_rules[<format:str>][<codec_type:str>] must yield a CodecRule representing expected
             codecs and whether conversion is warranted. Eg:
-            format_rules['mp4']['video'] = CodecRule( passthrough={'h264'}, convert={'mjpeg','mpeg4','mpeg2video','hevc','av1'} )
+            format_rules['mp4']['video'] = CodecRule( passthrough=frozenset({'h264'}), convert=frozenset({'mjpeg','mpeg4','mpeg2video','hevc','av1'}) )
+            Codec collections are stored as frozensets (any iterable is accepted).
 
         `conversion_rules`: A call to encode_rules[<codec_type:str>] should yield a Callable object with signature:
                 <stream_info:dict>, <ouput_container:str> -> <steps:List[dict]>
             Each step being a dict produced by either FFMPEGConvertStream, FFMPEGExtractStream or ExternalCommand
+            Arguments are passed by keyword: `stream_info`, `format`, `reason` (why the stream is converted: 'codec',
+            or 'bitrate' for a passthrough codec over `bitrate_limit`) and `bitrate_limit`.
 
         `drop_unknown_streams`: Whether to drop streams not covered by `format_rules`. May raise warnings on format
             incompatibility.
@@ -158,119 +316,232 @@ class CodecConstraintConverter:
         `keep_original_streams_rules`: Whether to drop stream that required transcoding. Recommended: True
 
         `bitrate_limit`: Overrides format_rules for any stream with higher bitrate, forcing them to be converted.
+
+        `probe_cache_dir`: Directory where ffprobe results are cached, so unchanged files (same size and
+            modification time) aren't probed again on later runs. None disables the cache.
+
+        `probe_parameters`: how much of each file ffprobe reads to find stream parameters (default:
+            PROBE_PARAMS, ffprobe's defaults). `probe_fallback_parameters` (default: PROBE_FALLBACK_PARAMS)
+            are used instead for files that can't be probed that way. ffmpeg commands don't use these.
+
+        `ffmpeg_input_parameters`: how much of each file ffmpeg reads before converting/remuxing it (default:
+            FFMPEG_INPUT_PARAMS); probing deeply there keeps audio and video in sync.
         '''
         self.ffmpeg_parameters = ffmpeg_parameters
-        self.format_rules = format_rules
+        self.probe_parameters = PROBE_PARAMS if probe_parameters is None else probe_parameters
+        self.probe_fallback_parameters = PROBE_FALLBACK_PARAMS if probe_fallback_parameters is None else probe_fallback_parameters
+        self.ffmpeg_input_parameters = FFMPEG_INPUT_PARAMS if ffmpeg_input_parameters is None else ffmpeg_input_parameters
+        self.format_rules = {
+            _format: {
+                codec_type: CodecRule( passthrough=frozenset(rule.passthrough), convert=frozenset(rule.convert) )
+                for codec_type, rule in rules.items()
+            }
+            for _format, rules in format_rules.items()
+        }
         self.conversion_rules = conversion_rules
         self.drop_unknown_streams = drop_unknown_streams
         self.keep_original_streams_rules = {} if keep_original_streams_rules is None else keep_original_streams_rules
         self.bitrate_limit = bitrate_limit
+        self.probe_cache_dir = probe_cache_dir
         self.OS = Os()
-
-        global FORMAT_COMPATIBILITY
-        format_compatibility_f = Path(__file__).parent / 'format_compatibility.json'
-        assert format_compatibility_f.is_file(), "ERROR: Could not load `format_compatibility.json`"
-        FORMAT_COMPATIBILITY = json.loads(format_compatibility_f.read_text())
+        self.streams_info_cache = {}
 
 
-    def produce_cmd_script( self, script: Path, commands: List[Command] ) -> None:
+    def produce_script( self, script: Path, commands: Iterable[Command], dialect: str ) -> None:
+        ''' writes a script file with commands, in `dialect` (key of SCRIPT_DIALECTS).
+        `commands` may be a generator: commands are written as they are produced
+        '''
+        _dialect = SCRIPT_DIALECTS[dialect]
+        _macros = _dialect['macros']
+        _command_to_str = self.command_to_str
+        # Commands are written one at a time, so the whole script is never held in memory
+        with script.open('w', buffering=1<<16, encoding='utf8', errors='ignore') as f:
+            write = f.write
+            write(_dialect['header'])
+            separator = ''
+            for _cmd in commands:
+                write(separator)
+                write(_command_to_str(patch_macro(_cmd, _macros)))
+                separator = '\n\n'
+
+
+    def produce_cmd_script( self, script: Path, commands: Iterable[Command] ) -> None:
         ''' writes a BAT file with commands
         '''
-
-        def patch_macro( c: Command ) -> Command:
-            if len(c)==1 and isinstance(c[0], str):
-                # May be a macro
-                if c[0].startswith("[ASSERT_EXIST]"):
-                    _file = c[0].replace("[ASSERT_EXIST]",'')
-                    return [
-                        f'IF NOT EXIST "{_file}" ( ECHO Error: Missing file "{_file} !" ) ELSE ( ECHO File confirmed to exist )'
-                    ]
-                if c[0].startswith("[MKDIR]"):
-                    return [c[0].replace("[MKDIR]",'MD')]
-                if c[0].startswith("[RMDIR]"):
-                    return [c[0].replace("[RMDIR]",'RD /S /Q')]
-            return c
-
-        script.write_text(
-            'chcp 65001\n@echo off\n\n' +
-            '\n\n'.join(
-                self.command_to_str(patch_macro(_cmd))
-                for _cmd in commands
-            ),
-            encoding='utf8',
-            errors='ignore'
-        )
+        self.produce_script(script, commands, 'bat')
 
 
-    def produce_bash_script( self, script: Path, commands: List[Command] ) -> None:
+    def produce_bash_script( self, script: Path, commands: Iterable[Command] ) -> None:
         ''' writes a SH file with commands
         '''
+        self.produce_script(script, commands, 'sh')
 
-        def patch_macro( c: Command ) -> Command:
-            if len(c)==1 and isinstance(c[0], str):
-                # May be a macro
-                if c[0].startswith("[ASSERT_EXIST]"):
-                    _file = c[0].replace("[ASSERT_EXIST]",'')
-                    return [
-                        f'if [ test -f "{_file}"]; then echo "Error: Missing file "{_file} !" else echo "File confirmed to exist" fi'
-                    ]
-                if c[0].startswith("[MKDIR]"):
-                    return [c[0].replace("[MKDIR]",'mkdir')]
-                if c[0].startswith("[RMDIR]"):
-                    return [c[0].replace("[RMDIR]",'rm -rf')]
-            return c
-
-        script.write_text(
-            '#!/bin/bash\n\n' +
-            '\n\n'.join(
-                self.command_to_str(patch_macro(_cmd))
-                for _cmd in commands
-            ),
-            encoding='utf8',
-            errors='ignore'
-        )
+
+    def probe_many( self, files: List[Path], max_workers: int = None ) -> None:
+        ''' Starts running ffprobe on `files` in the background (at most `max_workers` at a time),
+        in order. `plan_conversion` then only waits for the file it plans, so planning overlaps
+        with probing of the following files.
+        '''
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        for file in files:
+            self.streams_info_cache[file] = executor.submit(self.__probe_streams_info, file)
+        executor.shutdown(wait=False) # submitted probes still run
+
+
+    def get_streams_info( self, file: Path ) -> Dict[int,dict]:
+        ''' Returns ffprobe information on `file`'s streams, by stream index (probes `file` if needed)
+        '''
+        return self.__get_streams_info(file)
 
 
     def __get_streams_info( self, file: Path ) -> Dict[int,dict]:
-        ''' Use ffprobe to get stream information
+        ''' Get stream information, from cache if `file` was already probed (or is being probed)
+        '''
+        if file not in self.streams_info_cache:
+            self.streams_info_cache[file] = self.__probe_streams_info(file)
+        elif isinstance(self.streams_info_cache[file], Future):
+            self.streams_info_cache[file] = self.streams_info_cache[file].result()
+        return self.streams_info_cache[file]
+
+
+    def __probe_streams_info( self, file: Path ) -> Dict[int,dict]:
+        ''' Use ffprobe (or the probe cache) to get stream information
+        '''
+        streams = self.__read_probe_cache(file)
+        if streams is None:
+            streams = self.__ffprobe(file)
+            if streams is None:
+                return None
+            self.__write_probe_cache(file, streams)
+
+        # package information
+        _codec_types = CODEC_TYPES
+        return {
+            int(s['index']):s
+            for s in streams
+            if s['codec_type'] in _codec_types
+        }
+
+
+    def __probe_cache_entry( self, file: Path ) -> Path:
+        ''' Returns the path of the probe cache entry for `file`
+        '''
+        return self.probe_cache_dir / (hashlib.blake2b(str(file.resolve()).encode('utf8'), digest_size=16).hexdigest() + '.json')
+
+
+    def __read_probe_cache( self, file: Path ) -> List[dict]:
+        ''' Returns cached ffprobe streams for `file`, or None if there is no
+        cache entry, it is expired or `file` changed since it was cached
+        '''
+        if self.probe_cache_dir is None:
+            return None
+        cache_entry = self.__probe_cache_entry(file)
+        try:
+            if time.time() - cache_entry.stat().st_mtime > PROBE_CACHE_MAX_AGE:
+                cache_entry.unlink()
+                return None
+            cached = json_loads(cache_entry.read_bytes())
+        except (OSError, json.JSONDecodeError):
+            return None
+        if not isinstance(cached, dict):
+            return None
+        _stat = file.stat()
+        if cached.get('size')!=_stat.st_size or cached.get('mtime_ns')!=_stat.st_mtime_ns:
+            return None
+        if cached.get('entries')!=self.__ffprobe_entries():
+            return None # probed with different -show_entries (see DUMP_FFPROBE)
+        streams = cached.get('streams')
+        if not isinstance(streams, list) or not all(isinstance(s, dict) for s in streams):
+            return None
+        return streams
+
+
+    def __write_probe_cache( self, file: Path, streams: List[dict] ) -> None:
+        ''' Saves ffprobe streams for `file` to the probe cache. The entry is written
+        to a temporary file first, so an interrupted run can't leave a truncated entry
+        '''
+        if self.probe_cache_dir is None:
+            return
+        self.probe_cache_dir.mkdir(parents=True, exist_ok=True)
+        _stat = file.stat()
+        cache_entry = self.__probe_cache_entry(file)
+        tmp_entry = cache_entry.with_name(f'{cache_entry.name}.{os.getpid()}.tmp')
+        dump_json(
+            {
+                'file': str(file.resolve()),
+                'size': _stat.st_size,
+                'mtime_ns': _stat.st_mtime_ns,
+                'entries': self.__ffprobe_entries(),
+                'streams': streams
+            },
+            tmp_entry
+        )
+        os.replace(tmp_entry, cache_entry)
+
+
+    @staticmethod
+    def __ffprobe_entries() -> str:
+        ''' Returns the value of ffprobe's `-show_entries` parameter '''
+        return 'stream' if DUMP_FFPROBE else FFPROBE_ENTRIES
+
+
+    def __ffprobe( self, file: Path, fallback: bool = False ) -> List[dict]:
+        ''' Use ffprobe to get stream information. Only file headers are analyzed,
+        unless ffprobe fails or some required stream information is missing (then a deep probe is done)
         '''
         # Run ffprobe
         cmd = [
             'ffprobe',
             '-loglevel', 'error', # disable most messages
-            '-show_entries', 'stream', # output all streams
+            *(self.probe_fallback_parameters if fallback else self.probe_parameters),
+            '-show_entries', self.__ffprobe_entries(),
             '-of', 'json', # output format as json
             file
         ]
-        stdX = execute( cmd )
-
-        # Handle and decode output
-        if stdX['stderr'] != '':
-            print(f"Something went wrong: ffprobe stderr is: '{stdX['stderr']}' (type:{type(stdX['stderr'])})")
+        stdX = execute( cmd, decode=False )
+
+        # Handle output; stdout is parsed as bytes, stderr is only decoded on error
+        if stdX['stderr']:
+            if not fallback:
+                # eg: "Could not find codec parameters" on files with unusual layout
+                return self.__ffprobe(file, fallback=True)
+            print(f"Something went wrong: ffprobe stderr is: '{stdX['stderr'].decode('utf8', errors='backslashreplace')}'")
             return None
 
-        file_info = json.loads(stdX['stdout'])
+        file_info = json_loads(stdX['stdout'])
         assert "streams" in file_info, "No 'streams' in info"
 
+        if not fallback and any(
+            field not in s
+            for s in file_info['streams']
+            for field in PROBE_REQUIRED_FIELDS.get(s.get('codec_type'), ())
+        ):
+            return self.__ffprobe(file, fallback=True)
+
         if DUMP_FFPROBE:
             dump_json(file_info, file.with_suffix('.ffprobe.json'))
 
-        # package information
-        return {
-            int(s['index']):s
-            for s in file_info['streams']
-            if s['codec_type'] in self.CODEC_TYPES
-        }
+        return file_info['streams']
 
 
-    def stream_conversion( self, stream_info: dict, _format: str ) -> dict:
+    def ffmpeg_input( self, file: Path ) -> Command:
+        ''' Returns ffmpeg input parameters for `file`: unlike ffprobe's header probe,
+        ffmpeg commands probe deeply, as A/V sync of the output depends on it
+        '''
+        return [ *self.ffmpeg_input_parameters, '-i', file ]
+
+
+    def stream_conversion( self, stream_info: dict, _format: str, format_rules: Dict[str,CodecRule] = None ) -> dict:
         ''' Plans optimization for a particular stream given a target format
+
+        `format_rules`: `self.format_rules[_format]`, if already retrieved by caller
         '''
         #idx = stream_info['index']
         codec_type, codec_name = stream_info.get("codec_type"), stream_info.get("codec_name")
-        _codec_rule = self.format_rules[_format][codec_type]
-        __bitrates = [ y for y in [ stream_info.get('tags',{}).get(x) for x in ('BPS','BPS-eng') ] if y is not None ]
-        _bitrate = int( __bitrates.pop() ) if __bitrates else 0
+        _codec_rule = (self.format_rules[_format] if format_rules is None else format_rules)[codec_type]
+        _tags = stream_info.get('tags') or {}
+        __bitrate = _tags.get('BPS-eng') or _tags.get('BPS')
+        _bitrate = int(__bitrate) if __bitrate else 0
         if _bitrate==0 and codec_type!='attachment':
             print("Warning: Could not retrieve bitrate")
 
@@ -278,7 +549,7 @@ class CodecConstraintConverter:
             # Passthrough => copy if bitrate isn't too high, otherwise convert
             if _bitrate > self.bitrate_limit:
                 print(f"Warning: Forcing transcoding of stream {stream_info.get('index')}. Cause: bitrate too high ({_bitrate} > {self.bitrate_limit})")
-                return self.conversion_rules[codec_type](stream_info=stream_info,format=_format)
+                return self.conversion_rules[codec_type](stream_info=stream_info,format=_format,reason='bitrate',bitrate_limit=self.bitrate_limit)
             return [{'action': StreamAction.Copy}]
         if codec_name not in _codec_rule.convert:
             # Unlisted codec => drop or copy
@@ -292,26 +563,45 @@ class CodecConstraintConverter:
             return [{'action': StreamAction.Copy}]
 
         # Current stream needs to be converted => construct optimization plan
-        return self.conversion_rules[codec_type](stream_info=stream_info,format=_format)
+        return self.conversion_rules[codec_type](stream_info=stream_info,format=_format,reason='codec',bitrate_limit=self.bitrate_limit)
 
 
-    def ffmpeg_craft_command( self, in_file: Path, out_file: Path, conversion_plan: dict ) -> Command:
+    def ffmpeg_craft_command( self, in_file: Path, out_file: Path, conversion_plan: dict, extra_outputs: List[Tuple[int,dict,Path]] = None ) -> Command:
         ''' Craft a ffmpeg command for simple multi-stream conversion from `in_file` to `out_file`
+
+        `extra_outputs`: entries <stream_idx:int>, <step:dict>, <step_out_file:Path> for single-stream
+            steps written to their own file by the same command, so `in_file` is only read once.
+            `out_file` is omitted if `conversion_plan` is empty.
         '''
-        cmd = self.FFMPEG_CALL + [ '-i', in_file ]
+        cmd = [ *FFMPEG_CALL, *self.ffmpeg_input(in_file) ]
         out_idx = 0
         for stream_idx, stream_plan in conversion_plan.items():
-            patch = {'{in_file_idx}': '0', '{in_stream}': str(stream_idx), '{out_stream}': str(out_idx)}
-            cmd += [
-                patch_string(s, patch)
-                for s in stream_plan[0].get('ffmpeg_stream_parameters',[])
-            ]
+            patch = PatchContext(in_file_idx='0', in_stream=str(stream_idx), out_stream=str(out_idx))
+            cmd += apply_patch(stream_plan[0].get('compiled_stream_parameters',[]), patch)
             out_idx += 1
+        if conversion_plan:
+            cmd.append( out_file )
+
+        for stream_idx, step, step_out_file in (extra_outputs or []):
+            patch = PatchContext(in_file_idx='0', in_stream=str(stream_idx), out_stream='0')
+            cmd += apply_patch(step['compiled_stream_parameters'], patch) + [ step_out_file ]
 
-        cmd.append( out_file )
         return cmd
 
 
+    def step_output_file( self, in_file: Path, in_stream: int, tmp_dir: Path, step: dict ) -> Union[str,Path]:
+        ''' Returns the file a single-stream step writes to
+        '''
+        assert step['output_format'] is not None, f"Step has no output format: {step}"
+        if step['output_format']=='[NULL]':
+            return 'NUL' if self.OS.windows else '/dev/null'
+        return find_available_path(
+            root=tmp_dir,
+            base_name=f"{in_file.name}_{in_stream}.{step['codec']}.{step['output_format']}",
+            file=True
+        )
+
+
     def craft_complex_command( self, in_file: Path, in_stream: int, tmp_dir: Path, conversion_plan: dict ) -> Tuple[List[Command],Path]:
         ''' Crafts commands for stream, returns them plus the output file path
         '''
@@ -320,35 +610,26 @@ class CodecConstraintConverter:
         for step in conversion_plan:
 
             # Specify output file from output format
-            assert step['output_format'] is not None, f"Step has no output format: {step}"
             _out_fmt = step['output_format']
-            if _out_fmt=='[NULL]':
-                out_file = 'NUL' if self.OS.windows else '/dev/null'
-            else:
-                out_file = find_available_path(
-                    root=tmp_dir,
-                    base_name=f"{_in_file.name}_{_in_stream}.{step['codec']}.{step['output_format']}",
-                    file=True
-                )
+            out_file = self.step_output_file(_in_file, _in_stream, tmp_dir, step)
 
             # Craft command for step
-            patch = {'{in_file}': _in_file, '{in_file_idx}': '0', '{in_stream}': str(_in_stream), '{out_stream}': '0', '{out_file}': out_file}
+            patch = PatchContext(
+                in_file=_in_file, in_file_idx='0', in_stream=str(_in_stream), out_stream='0', out_file=out_file,
+                passlogfile=tmp_dir / f"{in_file.name}_{in_stream}.ffmpeg2pass"
+            )
             _action = step['action']
 
-            if _action in { StreamAction.Convert, StreamAction.Extract }:
-                _cmd = self.FFMPEG_CALL \
+            if _action is StreamAction.Convert or _action is StreamAction.Extract:
+                _cmd = [ *FFMPEG_CALL ] \
                     + (['-y'] if _out_fmt=='[NULL]' else []) \
-                    + [ '-i', _in_file ] + [
-                    patch_string(s, patch)
-                    for s in step['ffmpeg_stream_parameters']
-                ] + [ out_file ]
-            elif _action==StreamAction.External:
+                    + self.ffmpeg_input(_in_file) \
+                    + apply_patch(step['compiled_stream_parameters'], patch) \
+                    + [ out_file ]
+            elif _action is StreamAction.External:
                 if 'custom_output_file' in step and step['custom_output_file'] is not None:
                     out_file = step['custom_output_file'](_in_file)
-                _cmd = [
-                    patch_string(s, patch)
-                    for s in step['external_command']
-                ]
+                _cmd = apply_patch(step['compiled_command'], patch)
             else:
                 raise ValueError(f"Unexpected action: {_action}")
 
@@ -365,9 +646,16 @@ class CodecConstraintConverter:
         '''
         #print(f"command_to_str={cmd} ({type(cmd)})")
         return ' '.join(
-            c if isinstance(c, str) else f'"{c}"'
+            c if type(c) is str else quote(c)
             for c in cmd
-        ) if not isinstance(cmd, str) else cmd
+        ) if type(cmd) is not str else cmd
+
+
+    @staticmethod
+    def _metadata( out_stream_idx: int, name: str, value: str ) -> List[str]:
+        ''' Returns ffmpeg parameters setting metadata `name` of output stream `out_stream_idx`
+        '''
+        return [ f'-metadata:s:{out_stream_idx}', f'{name}="{value}"' ]
 
 
     def remux( self, source_file: Path, copy_streams: set, stream_files: dict, streams_info: dict, output_file: Path, optimized_streams: set ) -> Command:
@@ -387,21 +675,22 @@ class CodecConstraintConverter:
         '''
         if DEBUG_REMUX:
             print(f"stream_files:{stream_files}")
-        cmd = self.FFMPEG_CALL.copy() + [ '-i', source_file ]
-        # Index stream temporary files
-        _files = list(set(x['file'] for x in stream_files.values()))
+        cmd = [ *FFMPEG_CALL, *self.ffmpeg_input(source_file) ]
+        # Index stream temporary files (in order of first use; source file is input 0)
+        _file_index = {
+            f: idx
+            for idx, f in enumerate(dict.fromkeys(x['file'] for x in stream_files.values()), start=1)
+        }
         _file_index_by_stream = {
-            stream_idx: _files.index(stream_files[stream_idx]['file'])+1
-            for stream_idx in stream_files
+            stream_idx: _file_index[stream_file['file']]
+            for stream_idx, stream_file in stream_files.items()
         }
         # Add input files
-        for f in _files:
+        for f in _file_index:
             cmd += [ '-i', f ]
 
         out_stream_idx = 0
-        nb_streams = max(streams_info.keys())+1
-        for stream_idx in range(nb_streams):
-            _stream_info = streams_info[stream_idx]
+        for stream_idx, _stream_info in sorted(streams_info.items()):
             _lang = _stream_info.get('tags',{}).get('language', None)
             _title = _stream_info.get('tags',{}).get('title', '')
             _included_stream = False
@@ -415,22 +704,21 @@ class CodecConstraintConverter:
                 disposition = '0'
 
             if stream_idx in optimized_streams:
-                _file_index = _file_index_by_stream[stream_idx]
+                in_file_idx = _file_index_by_stream[stream_idx]
                 _file_stream_idx = stream_files[stream_idx]['idx']
                 _cmd = [
-                    '-map', f"{_file_index}:{_file_stream_idx}",
+                    '-map', f"{in_file_idx}:{_file_stream_idx}",
                     f'-c:{out_stream_idx}', 'copy'
                 ]
 
                 if _stream_info['codec_type']!='attachment':
-                    metadata = lambda _name, _val: [ f'-metadata:s:{out_stream_idx}', f'{_name}="{_val}"' ]
                     # Add language tag
                     if _lang:
-                        _cmd += metadata('language', _lang)
+                        _cmd += self._metadata(out_stream_idx, 'language', _lang)
 
                     # Add title tag
                     new_title = (f'[COMPAT] {_title}' if _title else '[COMPAT]') if stream_idx in optimized_streams else _title
-                    _cmd += metadata('title', new_title)
+                    _cmd += self._metadata(out_stream_idx, 'title', new_title)
 
                     # If possible, copy stream 'disposition': 'default' and 'forced' metadata
                     # Note: MP4 container picks first stream of each type as default
@@ -442,30 +730,74 @@ class CodecConstraintConverter:
                 _included_stream = True
 
             if stream_idx in copy_streams or _included_stream is False or self.keep_original_streams_rules[_stream_info['codec_type']]:
-                metadata = lambda _name, _val: [ f'-metadata:s:{out_stream_idx}', f'{_name}="{_val}"' ]
                 _cmd = [
                     '-map', f"0:{stream_idx}",
                     f'-c:{out_stream_idx}', 'copy'
                 ]
                 if _stream_info['codec_type']!='attachment':
-                    _cmd += metadata('title', _stream_info.get('tags',{}).get('title', '')) \
-                            + (metadata('language', _lang) if _lang else []) \
+                    _cmd += self._metadata(out_stream_idx, 'title', _title) \
+                            + (self._metadata(out_stream_idx, 'language', _lang) if _lang else []) \
                             + [ f'-disposition:s:{out_stream_idx}', disposition ]
                 if DEBUG_REMUX:
                     print(("Keeping a copy of" if _included_stream else "Copying original") + f" stream {stream_idx} with cmd: '{_cmd}'")
                 cmd += _cmd
                 out_stream_idx += 1
 
+        # MP4: put index (moov atom) at the beginning of the file so playback can start before download completes
+        if output_file.suffix=='.mp4':
+            cmd += [ '-movflags', '+faststart' ]
         cmd.append(output_file)
         return cmd
 
 
 
+    def _is_format_compatible( self, info: dict, plan: list, output_format: str ) -> bool:
+        ''' Checks that the stream resulting from `plan` can be stored in `output_format` '''
+        # keep orginal stream => its codec must be supported
+        if self.keep_original_streams_rules[info['codec_type']]:
+            if info['codec_name'] not in FORMAT_COMPATIBILITY[output_format]:
+                print(f"Aborting conversion: (Can't keep original stream) Codec {info['codec_name']} not compatible with format {output_format}")
+                return False
+
+        # target stream codec must be supported
+        _plan_codecs = [step['codec'] for step in plan if 'codec' in step and step['codec']!='copy']
+        if _plan_codecs:
+            if _plan_codecs[-1] not in FORMAT_COMPATIBILITY[output_format]:
+                print(f"Aborting conversion: Codec {_plan_codecs[-1]} not compatible with format {output_format}")
+                return False
+
+        return True
+
+
+    @staticmethod
+    def _display_plan_steps( idx: int, info: dict, plan: list ) -> None:
+        ''' Prints per-stream plan to output '''
+        if len(plan)==1:
+            # Most plans have a single step
+            _action = plan[0]['action']
+            dropped, copied = _action is StreamAction.Drop, _action is StreamAction.Copy
+        else:
+            _actions = { step['action'] for step in plan }
+            dropped, copied = StreamAction.Drop in _actions, _actions <= { StreamAction.Copy }
+        if dropped:  # Dropped stream
+            print(f"Dropping stream {idx} ({info['codec_name']} {info['codec_type']})")
+            return
+        if copied:  # Copied stream
+            return
+        stream_lang = info.get('tags',{}).get('language',None)
+        _lang =  f' (lang:{stream_lang})' if stream_lang else ''
+        codecs = [info['codec_name']] + [step['repr'] for step in plan if 'repr' in step]
+        print(f"Optimizing stream {idx}{_lang}: " + ' -> '.join( codecs ) )
+
+
     def plan_conversion( self, file: Path, output_format: str, output_file: Path ) -> List[Command]:
         ''' Plan the conversion of `file`
 
         `output_format`: container-specific file extension, must match an
             entry in `format_rules`.
+
+        Returns None if `file` can't be converted to `output_format`, and an empty
+        list if there is nothing to do (no stream to optimize or drop, same container).
         '''
 
         assert output_format in self.format_rules
@@ -477,77 +809,71 @@ class CodecConstraintConverter:
             base_name=file.stem,
             file=False
         )
-        all_commands.append( [f'[MKDIR] "{tmp_dir}"'] )
 
         # Get infos for each stream
         streams_info = self.__get_streams_info(file)
         if streams_info is None:
             return
 
-        def is_format_compatible( info: dict, plan: list ) -> bool:
-            ''' Prints per-stream plan to output '''
-            nonlocal output_format
-
-            # keep orginal stream => its codec must be supported
-            if self.keep_original_streams_rules[info['codec_type']]:
-                if info['codec_name'] not in FORMAT_COMPATIBILITY[output_format]:
-                    print(f"Aborting conversion: (Can't keep original stream) Codec {info['codec_name']} not compatible with format {output_format}")
-                    return False
-
-            # target stream codec must be supported
-            _plan_codecs = [step['codec'] for step in plan if 'codec' in step and step['codec']!='copy']
-            if _plan_codecs:
-                if _plan_codecs[-1] not in FORMAT_COMPATIBILITY[output_format]:
-                    print(f"Aborting conversion: Codec {_plan_codecs[-1]} not compatible with format {output_format}")
-                    return False
-
-            return True
-
-        def display_plan_steps( idx: int, info: dict, plan: list ) -> None:
-            ''' Prints per-stream plan to output '''
-            if any(step['action']==StreamAction.Drop for step in plan):  # Dropped stream
-                print(f"Dropping stream {idx} ({info['codec_name']} {info['codec_type']})")
-                return
-            stream_lang = info.get('tags',{}).get('language',None)
-            _lang =  f' (lang:{stream_lang})' if stream_lang else ''
-            #_codecs = [info['codec_name']] + [step['codec'] for step in plan if 'codec' in step and step['codec']!='copy']
-            if all(step['action'] is StreamAction.Copy for step in plan):  # Copied stream
-                return
-            codecs = [info['codec_name']] + [step['repr'] for step in plan if 'repr' in step]
-            print(f"Optimizing stream {idx}{_lang}: " + ' -> '.join( codecs ) )
-
-
         # Get plans for individual streams
-        simple_conversion, other_conversion, optimized_streams, copy_streams = {}, {}, set(), set()
-        for stream_idx, stream_info in streams_info.items():
-            stream_plan = self.stream_conversion(stream_info, output_format)
-            if not is_format_compatible(stream_info, stream_plan):
-                return
-            display_plan_steps( stream_idx, stream_info, stream_plan )
+        _format_rules = self.format_rules[output_format]
+        stream_plans = {
+            stream_idx: self.stream_conversion(stream_info, output_format, _format_rules)
+            for stream_idx, stream_info in streams_info.items()
+        }
+        # Check all streams fit `output_format` before committing to a plan
+        if not all(self._is_format_compatible(streams_info[idx], plan, output_format) for idx, plan in stream_plans.items()):
+            return
+
+        source_format = file.suffix[1:].lower()
+        simple_conversion, other_conversion, optimized_streams, copy_streams, dropped_streams = {}, {}, set(), set(), set()
+        for stream_idx, stream_plan in stream_plans.items():
+            stream_info = streams_info[stream_idx]
+            self._display_plan_steps( stream_idx, stream_info, stream_plan )
             if len(stream_plan)==0:
                 raise ValueError(f"No plan for stream {stream_idx}")
             if len(stream_plan)==1:
-                if stream_plan[0]['action'] == StreamAction.Copy and stream_info['codec_name'] in FORMAT_COMPATIBILITY[file.suffix[1:]]:
+                if stream_plan[0]['action'] is StreamAction.Copy and stream_info['codec_name'] in FORMAT_COMPATIBILITY[source_format]:
                     copy_streams.add(stream_idx)
                     continue
-                if stream_plan[0]['action'] == StreamAction.Convert and stream_plan[0]['codec'] in FORMAT_COMPATIBILITY[file.suffix[1:]]:
+                if stream_plan[0]['action'] is StreamAction.Convert and stream_plan[0]['codec'] in FORMAT_COMPATIBILITY[source_format]:
                     simple_conversion[stream_idx] = stream_plan
                     optimized_streams.add(stream_idx)
                     continue
-                if stream_plan[0]['action'] == StreamAction.Drop:
+                if stream_plan[0]['action'] is StreamAction.Drop:
+                    dropped_streams.add(stream_idx)
                     continue
             other_conversion[stream_idx] = stream_plan
             optimized_streams.add(stream_idx)
 
+        if not optimized_streams and not dropped_streams and output_format==source_format:
+            print("Nothing to optimize")
+            return []
+
+        # Intermediary files are only needed for streams that are converted
+        if simple_conversion or other_conversion:
+            all_commands.append( [f'[MKDIR] "{tmp_dir}"'] )
+
+        # First steps of other streams reading the source file are done along with
+        # simple conversions, so the source file is read only once
+        source_steps = [
+            (stream_idx, stream_plan[0], self.step_output_file(file, stream_idx, tmp_dir, stream_plan[0]))
+            for stream_idx, stream_plan in other_conversion.items()
+            if stream_plan[0]['action'] in ( StreamAction.Convert, StreamAction.Extract )
+            and stream_plan[0]['output_format']!='[NULL]'
+        ]
+
         # Steps for streams with simple conversion or copy
-        if simple_conversion:
-            simple_conversion_file = tmp_dir / f'simple_conversion{file.suffix}'
+        simple_conversion_file = tmp_dir / f'simple_conversion{file.suffix}'
+        if simple_conversion or source_steps:
             simple_conversion_cmd = self.ffmpeg_craft_command(
                 in_file=file,
                 out_file=simple_conversion_file,
-                conversion_plan=simple_conversion
+                conversion_plan=simple_conversion,
+                extra_outputs=source_steps
             )
             all_commands.append( simple_conversion_cmd )
+        source_step_files = { stream_idx: step_out_file for stream_idx, _, step_out_file in source_steps }
 
         # Steps for other streams
         tmp_files = {
@@ -559,22 +885,30 @@ class CodecConstraintConverter:
             ])
         }
         for stream_idx, stream_plan in other_conversion.items():
-            commands, out_file = self.craft_complex_command(
-                in_file=file,
-                in_stream=stream_idx,
-                tmp_dir=tmp_dir,
-                conversion_plan=stream_plan
-            )
+            if stream_idx in source_step_files:
+                commands, out_file = self.craft_complex_command(
+                    in_file=source_step_files[stream_idx],
+                    in_stream=0,
+                    tmp_dir=tmp_dir,
+                    conversion_plan=stream_plan[1:]
+                )
+            else:
+                commands, out_file = self.craft_complex_command(
+                    in_file=file,
+                    in_stream=stream_idx,
+                    tmp_dir=tmp_dir,
+                    conversion_plan=stream_plan
+                )
             all_commands += commands
             tmp_files[stream_idx] = { 'file': out_file, 'idx': 0 }
 
         # Check for individual steps completion
         all_commands += [
             [ f"[ASSERT_EXIST]{_out_file}" ]
-            for _out_file in {
+            for _out_file in dict.fromkeys( # deduplicated, in a stable order
                 x['file']
                 for x in tmp_files.values()
-            }
+            )
         ]
 
         # Remux step
@@ -589,6 +923,7 @@ class CodecConstraintConverter:
         all_commands.append( remux_cmd )
 
         # Cleanup
-        all_commands.append( [f'[RMDIR] "{tmp_dir}"'] )
+        if simple_conversion or other_conversion:
+            all_commands.append( [f'[RMDIR] "{tmp_dir}"'] )
 
         return all_commands
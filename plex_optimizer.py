@@ -155,28 +155,161 @@ https://github.com/gpac/gpac/wiki/Subtitling-with-GPAC
 '''
 
 import argparse
+import os
+import re
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import chain, islice
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
-from codec_constraint_converter import CodecConstraintConverter, CodecRule, FFMPEGConvertStream, FFMPEGExtractStream, ExternalCommand, DropStream
-from utils import find_available_path, cli_explorer, file_collector
+from codec_constraint_converter import CodecConstraintConverter, CodecRule, FFMPEGConvertStream, FFMPEGExtractStream, ExternalCommand, DropStream, get_ffmpeg_encoders, ffmpeg_encoder_test_command
+from utils import find_available_path, cli_explorer, fast_file_collector, execute_many
 from os_detect import Os
 
 # Adapt these constants to your needs
-SRC_FILE_EXT = { '.mp4', '.mkv' }
+SRC_FILE_EXT = frozenset({ 'mp4', 'mkv' }) # lowercase, without dot
 PGSTOSRT_DLL = Path('G:/Downloads/PgsToSrt-master/PgsToSrt/out/PgsToSrt.dll')
 
 # Dont touch these values unless you know what you're doing
-FFMPEG_PARAMETERS = ["-loglevel", "warning", "-stats", "-probesize", "100G", "-analyzeduration", "100G"]
-H264_EXTRA_PARAMS = None # [ "-preset", "slow", "-crf", "23" ]
+FFMPEG_PARAMETERS = ["-loglevel", "warning", "-stats"]
+# h264 encoding settings, built from CLI arguments: `params` is a tuple (eg: ("-preset", "slow", "-crf", "23")),
+# `two_pass` is set for libx264 in target bitrate mode, unless `--x264_rate_mode 1pass_vbr`
+EncoderConfig = namedtuple(typename='EncoderConfig', field_names=['encoder','params','two_pass'])
+H264_ENCODERS = { # `--encoder` choice -> ffmpeg encoder, in order of preference for `--encoder auto`
+    'nvenc': 'h264_nvenc',
+    'qsv': 'h264_qsv',
+    'amf': 'h264_amf',
+    'cpu': 'libx264'
+}
+FFMPEG_THREADS_ENV = 'PLEX_OPT_FFMPEG_THREADS'
+FFMPEG_MAX_THREADS = 64
+BITRATE_RE = re.compile(r'\s*(\d+(?:\.\d+)?)\s*([kKmM]?)\s*')
+BITRATE_MULTIPLIERS = { '': 1, 'k': 1000, 'm': 1000000 }
+
+# Codec rules per output format; video/audio rules are the same for all formats
+_VIDEO_RULE = CodecRule(
+    passthrough=frozenset({ 'h264' }),
+    convert=frozenset({ 'mjpeg', 'mpeg4', 'mpeg2video', 'hevc', 'av1', "vp9" })
+)
+_AUDIO_RULE = CodecRule(
+    passthrough=frozenset({ 'mp2', 'mp3', 'aac', 'ac3', 'eac3' }),
+    convert=frozenset({ 'flac', 'vorbis', 'opus', 'dts' })
+)
+FORMAT_RULES = {
+    'mp4': {
+        'video': _VIDEO_RULE,
+        'audio': _AUDIO_RULE,
+        'subtitle': CodecRule( # missing: 'dvd_subtitle'
+            passthrough=frozenset({ 'mov_text' }),
+            convert=frozenset({ 'webvtt', 'ass', 'subrip', "hdmv_pgs_subtitle" })
+        ),
+        'attachment': CodecRule(
+            passthrough=frozenset(),
+            convert=frozenset()
+        )
+    },
+    'mkv': {
+        'video': _VIDEO_RULE,
+        'audio': _AUDIO_RULE,
+        'subtitle': CodecRule( # missing: 'dvd_subtitle'
+            passthrough=frozenset({ 'subrip' }),
+            convert=frozenset({ 'mov_text', 'webvtt', 'ass', "hdmv_pgs_subtitle" })
+        ),
+        'attachment': CodecRule(
+            passthrough=frozenset({ 'ttf' }),
+            convert=frozenset()
+        )
+    }
+}
 
 CWD = Path(".").resolve()
 SCRIPT_PATH = Path(__file__).resolve().parent
+PROBE_CACHE_DIR = Path.home() / '.cache' / 'plex_optimizer' / 'ffprobe'
+
+
+def ffmpeg_threads_per_invocation( n_workers: int, requested: Optional[str] = None ) -> Optional[int]:
+    ''' Returns the number of threads each ffmpeg invocation may use, so that `n_workers`
+    concurrent invocations don't oversubscribe the CPU. An explicit value (`requested`, else
+    environment variable PLEX_OPT_FFMPEG_THREADS) takes precedence. Result is clamped to
+    [1,FFMPEG_MAX_THREADS]; None means ffmpeg is left to decide.
+    '''
+    _threads = requested or os.environ.get(FFMPEG_THREADS_ENV)
+    if _threads is None:
+        if n_workers <= 1:
+            return None
+        _threads = (os.cpu_count() or 1) // n_workers
+    return min(max(int(_threads), 1), FFMPEG_MAX_THREADS)
+
+
+def pick_h264_encoder( choice: str ) -> str:
+    ''' Returns the ffmpeg encoder for `--encoder` value `choice`. With 'auto',
+    the first encoder from H264_ENCODERS that actually works is picked.
+    '''
+    if choice!='auto':
+        return H264_ENCODERS[choice]
+    available_encoders = get_ffmpeg_encoders()
+    candidates = [ encoder for encoder in H264_ENCODERS.values() if encoder in available_encoders ]
+    # All candidates are tested at once, the first one that works is picked
+    results = execute_many( [ ffmpeg_encoder_test_command(encoder) for encoder in candidates ], decode=False )
+    for encoder, stdX in zip(candidates, results):
+        if stdX['stderr'] == b'':
+            return encoder
+    return H264_ENCODERS['cpu']
+
+
+def parse_bitrate( bitrate: str ) -> int:
+    ''' Returns bitrate in bps from a string with optional suffix K (kbps) or M (mbps) (case insensitive),
+    eg: '650k' -> 650000, '7.5M' -> 7500000
+    '''
+    match = BITRATE_RE.fullmatch(bitrate)
+    if match is None:
+        raise ValueError(f"Invalid bitrate '{bitrate}': expected a number with optional suffix K or M (eg: 7M)")
+    value, suffix = match.groups()
+    return int(float(value) * BITRATE_MULTIPLIERS[suffix.lower()])
+
+
+def bitrate_argument( bitrate: str ) -> int:
+    ''' argparse `type` for bitrate arguments: like parse_bitrate, but invalid values are
+    reported as a usage error
+    '''
+    try:
+        return parse_bitrate(bitrate)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from e
 
 
-def optimize_video_to_h264(*_, **kwargs):
+def h264_rate_control_params( encoder: str, preset: str, crf: str, target_bitrate: Optional[str], vbr: bool = False ) -> List[str]:
+    ''' Returns encoder-specific parameters for either constant quality (`crf`) or
+    target bitrate mode. Only libx264 honors `preset` and uses 2-pass in target bitrate mode,
+    unless `vbr` is set (1-pass, with peak bitrate constrained to 1.5x the target).
+    '''
+    if encoder=='h264_nvenc':
+        if target_bitrate is None:
+            return [ "-preset", "p6", "-rc", "vbr", "-cq", crf, "-b:{out_stream}", "0", "-profile:{out_stream}", "high" ]
+        return [ "-preset", "p6", "-rc", "vbr", "-b:{out_stream}", target_bitrate, "-profile:{out_stream}", "high" ]
+    if encoder=='h264_qsv':
+        if target_bitrate is None:
+            return [ "-preset", "veryslow", "-global_quality", crf ]
+        return [ "-preset", "veryslow", "-b:{out_stream}", target_bitrate ]
+    if encoder=='h264_amf':
+        if target_bitrate is None:
+            return [ "-quality", "quality", "-rc", "cqp", "-qp_i", crf, "-qp_p", crf, "-qp_b", crf ]
+        return [ "-quality", "quality", "-rc", "vbr_peak", "-b:{out_stream}", target_bitrate ]
+    if target_bitrate is None:
+        return [ "-preset", preset, "-crf", crf ]
+    if vbr:
+        _bps = parse_bitrate(target_bitrate)
+        return [ "-preset", preset, "-b:{out_stream}", target_bitrate,
+            "-maxrate:{out_stream}", str(int(_bps*1.5)), "-bufsize:{out_stream}", str(_bps*3) ]
+    return [ "-preset", preset, "-b:{out_stream}", target_bitrate ]
+
+
+def optimize_video_to_h264(*_, encoder_config: EncoderConfig, **kwargs):
     ''' Convert video stream to h264 with resolution <=FHD and
-    bit depth 8.
+    bit depth 8. `encoder_config` is bound with functools.partial.
     '''
     # print(f"args:{args}, kwargs:{kwargs}")
     stream_info = kwargs['stream_info']
@@ -192,17 +325,70 @@ def optimize_video_to_h264(*_, **kwargs):
         # 10-bit -> 8bit
         param.append("-pix_fmt yuv420p")
 
-    param += H264_EXTRA_PARAMS
+    param += encoder_config.params
+    if kwargs.get('reason')=='bitrate':
+        # Converted only because of its bitrate => make sure the new one is within limits
+        _limit = int(kwargs['bitrate_limit'])
+        param += [ "-maxrate:{out_stream}", str(_limit), "-bufsize:{out_stream}", str(2*_limit) ]
+    # Hardware encoder (always 1-pass)
+    if encoder_config.encoder!='libx264':
+        return [ FFMPEGConvertStream(codec='h264', parameters=param, output_format='mp4', repr_complement=f' ({encoder_config.encoder})', encoder=encoder_config.encoder) ]
     # 1-pass mode
-    if "-crf" in H264_EXTRA_PARAMS:
+    if not encoder_config.two_pass:
         return [ FFMPEGConvertStream(codec='h264', parameters=param, output_format='mp4') ]
-    # 2-pass mode
+    # 2-pass mode (per-stream log file, so concurrent encodes don't clash)
+    param += [ '-passlogfile', '{passlogfile}' ]
     return [
         FFMPEGConvertStream(codec='h264', parameters=param + ['-pass','1','-f','mp4'], output_format='[NULL]', repr_complement=' (1/2 pass)'),
         FFMPEGConvertStream(codec='h264', parameters=param + ['-pass','2'], output_format='mp4', repr_complement=' (2/2 pass)')
     ]
 
 
+def build_ladder_filter_complex( target_heights: List[int], cascade: bool = False ) -> str:
+    ''' Returns a filtergraph decoding the first video stream once and producing one
+    8-bit output per height, labelled [v0], [v1], ... (never upscaled).
+    eg: [0:v:0]split=2[s0][s1];[s0]scale=-2:min(ih\\,720),format=yuv420p[v0];[s1]...
+
+    `cascade`: each height is scaled from the next higher one instead of from the
+    source, so each scaler handles a smaller input (at a marginal quality cost).
+    eg: [0:v:0]scale=-2:min(ih\\,720),format=yuv420p,split=2[v0][c0];[c0]scale=-2:min(ih\\,480)[v1]
+    '''
+    nb_rungs = len(target_heights)
+    if not cascade:
+        return f"[0:v:0]split={nb_rungs}" + ''.join(f"[s{i}]" for i in range(nb_rungs)) + ';' + ';'.join(
+            f"[s{i}]scale=-2:min(ih\\,{h}),format=yuv420p[v{i}]"
+            for i, h in enumerate(target_heights)
+        )
+    # Highest to lowest height; output labels follow the order of `target_heights`
+    rungs = sorted(range(nb_rungs), key=lambda i: target_heights[i], reverse=True)
+    _filters, _input = [], '[0:v:0]'
+    for rank, i in enumerate(rungs):
+        _filter = f"{_input}scale=-2:min(ih\\,{target_heights[i]})" + (",format=yuv420p" if rank==0 else '')
+        if rank < nb_rungs-1:
+            _filter += f",split=2[v{i}][c{rank}]"
+            _input = f"[c{rank}]"
+        else:
+            _filter += f"[v{i}]"
+        _filters.append(_filter)
+    return ';'.join(_filters)
+
+
+def ladder_command( converter: CodecConstraintConverter, source_file: Path, optimized_file: Path, ladder_files: List[Path], target_heights: List[int], encoder_config: EncoderConfig, cascade: bool = False ) -> List:
+    ''' Crafts a single ffmpeg command producing lower resolution versions of `optimized_file`.
+    Video is scaled from `source_file` (one decode for all heights, no generation loss),
+    other streams are copied from `optimized_file`. See build_ladder_filter_complex for `cascade`.
+    Inputs are probed like in `converter`'s commands.
+    '''
+    cmd = [ *converter.FFMPEG_CALL, *converter.ffmpeg_input(source_file), *converter.ffmpeg_input(optimized_file),
+        '-filter_complex', f'"{build_ladder_filter_complex(target_heights, cascade)}"' ]
+    for i, ladder_file in enumerate(ladder_files):
+        cmd += [ '-map', f'"[v{i}]"', '-map', '1', '-map', '-1:v', '-c', 'copy', '-c:v', encoder_config.encoder ] \
+            + [ x.replace('{out_stream}', 'v') for x in encoder_config.params ] \
+            + ([ '-movflags', '+faststart' ] if ladder_file.suffix=='.mp4' else []) \
+            + [ ladder_file ]
+    return cmd
+
+
 def optimize_audio_to_aac_or_ac3(*_, **kwargs):
     ''' Convert audio stream to aac or ac3
     '''
@@ -217,9 +403,11 @@ def optimize_audio_to_aac_or_ac3(*_, **kwargs):
     return  [ FFMPEGConvertStream(codec='ac3') ]
 
 
+@lru_cache(maxsize=32)
 def PGS_OCR_to_SRT_command( lang: str ) -> list:
     ''' Use project PgsToSrt to convert PGS subtitles (SUP container) to SRT
     see: https://github.com/Tentacule/PgsToSrt
+    Cached: one step per language, shared by all streams in that language.
     '''
     return ExternalCommand(
         command=[
@@ -234,72 +422,88 @@ def PGS_OCR_to_SRT_command( lang: str ) -> list:
     )
 
 
+WEBVTT_SANITIZE_SCRIPT = SCRIPT_PATH / 'webvtt_sanitize.py'
+assert WEBVTT_SANITIZE_SCRIPT.is_file(), f"ERROR: Could not find `{WEBVTT_SANITIZE_SCRIPT.name}`"
+_WEBVTT_SANITIZE_COMMAND = ExternalCommand(
+    command=[
+        'python', WEBVTT_SANITIZE_SCRIPT,
+        '-i', "{in_file}",
+        '-o', "{out_file}"
+    ],
+    output_codec='webvtt (optimized)',
+    output_format='vtt'
+)
+
+
 def webvtt_sanitize_LR() -> list:
     ''' Use external script to 'sanitize'/optimize webvtt for conversion to
-    MOV_TEXT
+    MOV_TEXT. The step is the same for all streams, so it is built once.
     '''
-    external_script = SCRIPT_PATH / 'webvtt_sanitize.py'
-    assert external_script.is_file()
-    return ExternalCommand(
-        command=[
-            'python', external_script,
-            '-i', "{in_file}",
-            '-o', "{out_file}"
-        ],
-        output_codec='webvtt (optimized)',
-        output_format='vtt'
-    )
+    return _WEBVTT_SANITIZE_COMMAND
+
+
+def _pgs_language( stream_info: dict ) -> str:
+    ''' Returns language tag of a PGS subtitle stream (for OCR) '''
+    return stream_info.get('tags',{}).get('language',None)
+
+
+# Subtitle conversion plans: <output_format>: <codec>: steps, or a callable returning them from stream_info.
+# Steps don't depend on the stream, so they are built once and shared (plans aren't modified).
+_EXTRACT_PGS = FFMPEGExtractStream( codec='copy', output_format='sup' )
+_EXTRACT_WEBVTT = FFMPEGExtractStream( codec='webvtt', output_format='vtt' )
+_CONVERT_MOV_TEXT = FFMPEGConvertStream( codec='mov_text', output_format='mp4' )
+_SUBRIP_SRT = FFMPEGConvertStream( codec='subrip', output_format='srt' )
+_SUBTITLE_PLANS = {
+    'mp4': {
+        'mov_text': ( FFMPEGConvertStream(codec='copy', output_format='mp4'), ), # natively compatible
+        'webvtt': ( webvtt_sanitize_LR(), _CONVERT_MOV_TEXT ), # need simple conversion step
+        'subrip': ( webvtt_sanitize_LR(), _CONVERT_MOV_TEXT ),
+        'ass': ( _EXTRACT_WEBVTT, webvtt_sanitize_LR(), _CONVERT_MOV_TEXT ), # need complex conversion step
+        'hdmv_pgs_subtitle': lambda stream_info: [ # need complex conversion step including OCR
+            _EXTRACT_PGS, PGS_OCR_to_SRT_command( lang=_pgs_language(stream_info) ), _CONVERT_MOV_TEXT
+        ]
+    },
+    'mkv': {
+        'subrip': ( FFMPEGConvertStream(codec='copy', output_format='mkv'), ), # natively compatible
+        'webvtt': ( FFMPEGConvertStream(codec='subrip', output_format='mkv'), ), # simple conversion for incompatible or less popular codec
+        'mov_text': ( FFMPEGConvertStream(codec='subrip', output_format='mkv'), ),
+        'ass': ( _EXTRACT_WEBVTT, _SUBRIP_SRT ), # need complex conversion step
+        'ssa': ( _EXTRACT_WEBVTT, _SUBRIP_SRT ),
+        'hdmv_pgs_subtitle': lambda stream_info: [ # need complex conversion step including OCR
+            _EXTRACT_PGS, PGS_OCR_to_SRT_command( lang=_pgs_language(stream_info) )
+        ]
+    }
+}
 
 
 def optimize_subtitle_to_mov_text_or_srt(*_, **kwargs):
-    ''' Subtitle conversion to mov_text or srt '''
+    ''' Subtitle conversion to mov_text or srt (see _SUBTITLE_PLANS) '''
     # print(f"args:{args}, kwargs:{kwargs}")
     codec, output_format = kwargs['stream_info']['codec_name'], kwargs['format']
+    if output_format not in _SUBTITLE_PLANS:
+        raise ValueError(f"Unexpected format '{output_format}'")
 
-    if output_format=='mp4':
-        if codec=='mov_text': # natiely compatible
-            return [ FFMPEGConvertStream(codec='copy', output_format='mp4') ]
-        if codec in {'webvtt', 'subrip'}: # need simple conversion step
-            return [
-                webvtt_sanitize_LR(),
-                FFMPEGConvertStream(codec='mov_text', output_format='mp4')
-            ]
-        if codec=='ass': # need complex conversion step
-            return [
-                FFMPEGExtractStream( codec='webvtt', output_format='vtt'),
-                webvtt_sanitize_LR(),
-                FFMPEGConvertStream( codec='mov_text', output_format='mp4' )
-            ]
-        if codec=="hdmv_pgs_subtitle": # need complex conversion step including OCR
-            _lang = kwargs['stream_info'].get('tags',{}).get('language',None)
-            return [
-                FFMPEGExtractStream( codec='copy', output_format='sup' ),
-                PGS_OCR_to_SRT_command( lang=_lang ),
-                FFMPEGConvertStream( codec='mov_text', output_format='mp4' )
-            ]
-        # else: not handled => Drop stream
+    plan = _SUBTITLE_PLANS[output_format].get(codec)
+    if plan is None: # not handled => Drop stream
         return [ DropStream() ]
+    if callable(plan):
+        return plan(kwargs['stream_info'])
+    return list(plan)
 
-    if output_format=='mkv':
-        if codec=='subrip': # natively compatible
-            return [ FFMPEGConvertStream(codec='copy', output_format='mkv') ]
-        if codec in {'webvtt', 'mov_text'}: # simple conversion for incompatible or less popular codec
-            return [ FFMPEGConvertStream(codec='subrip', output_format='mkv') ]
-        if codec in {'ass', 'ssa'}: # need complex conversion step
-            return [
-                FFMPEGExtractStream( codec='webvtt', output_format='vtt'),
-                FFMPEGConvertStream( codec='subrip', output_format='srt' )
-            ]
-        if codec=="hdmv_pgs_subtitle": # need complex conversion step including OCR
-            _lang = kwargs['stream_info'].get('tags',{}).get('language',None)
-            return [
-                FFMPEGExtractStream( codec='copy', output_format='sup' ),
-                PGS_OCR_to_SRT_command( lang=_lang )
-            ]
-        # else: not handled => Drop stream
-        return [ DropStream() ]
 
-    raise ValueError(f"Unexpected format '{format}'")
+def run_scripts( scripts: List[Path], max_workers: int ) -> None:
+    ''' Runs conversion scripts concurrently (at most `max_workers` at a time)
+    '''
+    is_windows = Os().windows
+
+    def run_script( script: Path ) -> int:
+        cmd = [ 'cmd', '/c', str(script) ] if is_windows else [ 'bash', str(script) ]
+        return subprocess.call( cmd, cwd=script.parent )
+
+    nb_scripts = len(scripts)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for idx, (script, returncode) in enumerate(zip(scripts, executor.map(run_script, scripts))):
+            print(f"[{idx+1}/{nb_scripts}] {script.name}: " + ("done" if returncode==0 else f"failed (exit code {returncode})"))
 
 
 def get_args() -> argparse.Namespace:
@@ -336,20 +540,62 @@ def get_args() -> argparse.Namespace:
     parser.add_argument(
         '--threads',
         action="store",
-        help="Sets limit on threads used by h264 encoder."
+        help=f"Sets limit on threads used by h264 encoder (default: environment variable {FFMPEG_THREADS_ENV} if set, else chosen by ffmpeg)."
+    )
+    parser.add_argument(
+        '--jobs',
+        action="store",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of files probed (and converted, with `--run`) in parallel (default: number of CPUs)."
+    )
+    parser.add_argument(
+        '--run',
+        action="store_true",
+        help="Run produced scripts right away, `--jobs` of them at a time. Threads per ffmpeg instance are limited accordingly (see `--threads`)."
+    )
+    parser.add_argument(
+        '--no_cache',
+        action="store_true",
+        help="Don't use (or update) the cache of ffprobe results (in `~/.cache/plex_optimizer/ffprobe`)."
+    )
+    parser.add_argument(
+        '--ladder',
+        nargs="*",
+        type=int,
+        default=[],
+        metavar='HEIGHT',
+        help="Also produce lower resolution versions of optimized files, eg: `--ladder 720 480` (all encoded by " \
+            + "a single ffmpeg call scaling the source's video, in constant quality mode)."
+    )
+    parser.add_argument(
+        '--ladder_cascade',
+        action="store_true",
+        help="With `--ladder`, scale each version from the next higher one (eg: 1080p -> 720p -> 480p) instead of " \
+            + "from the source, which reduces scaling work at a marginal quality cost."
     )
     parser.add_argument(
         '--format',
         nargs="*",
         default=["mp4","mkv"],
-        help="Override output format range (Default equivalent to `--format mp4 mkv`)."
+        help="Override output format range, in order of preference: each file is converted to the first format " \
+            + "that can hold its streams (Default equivalent to `--format mp4 mkv`)."
     )
     parser.add_argument(
         '--bitrate_limit',
         action="store",
+        type=bitrate_argument,
         default='7M',
         help="Maximum bitrate for a stream (default: 7M=7000000). Heavier streams are forcibly converted. Accepted suffixes are K (kbps) and M (mbps) (case insensitive)."
     )
+    parser.add_argument(
+        '--encoder',
+        choices=['auto', *H264_ENCODERS],
+        default='cpu',
+        help="h264 encoder: 'cpu' (libx264), 'nvenc' (NVIDIA GPU), 'qsv' (Intel GPU), 'amf' (AMD GPU) " \
+            + "or 'auto' to use the first working one in that order. Hardware encoders ignore `--x264_preset`, " \
+            + "map `--x264_crf` to their constant quality mode and always run in 1-pass mode. Default: cpu"
+    )
     parser.add_argument(
         '--x264_preset',
         action="store",
@@ -366,20 +612,26 @@ def get_args() -> argparse.Namespace:
     x264_rate.add_argument(
         '--x264_target_bitrate',
         action="store",
-        help="Sets value for `-b` used by h264 encoder (2-pass mode)."
+        help="Sets value for `-b` used by h264 encoder (2-pass mode, see `--x264_rate_mode`)."
+    )
+    parser.add_argument(
+        '--x264_rate_mode',
+        choices=['2pass_abr', '1pass_vbr'],
+        default='2pass_abr',
+        help="libx264 mode with `--x264_target_bitrate`: '2pass_abr' (2-pass average bitrate), or '1pass_vbr' " \
+            + "(single pass with peak bitrate at 1.5x the target, about twice as fast). Default: 2pass_abr"
     )
     return parser.parse_args()
 
 
 def yes_or_no( msg: str ) -> bool:
     ''' Prompts the user for a Y/N '''
+    prompt = msg + " [Y/N] "
     while True:
-        _user_input = input(msg + " [Y/N] ")
-        if len(_user_input)!=1:
-            continue
-        if _user_input.lower()=='y':
+        _user_input = input(prompt).lower()
+        if _user_input=='y':
             return True
-        if _user_input.lower()=='n':
+        if _user_input=='n':
             return False
 
 
@@ -387,36 +639,89 @@ def get_files( src_dir: Path ) -> List[Path]:
     ''' Get list of video files within `src_dir`
     '''
     _recursive = yes_or_no("Should the file search be recursive ?")
-    return list(
-        filter(
-            lambda f: f.suffix in SRC_FILE_EXT and '.optimized' not in f.name,
-            file_collector(
-                root=src_dir,
-                pattern=('**' if _recursive else '.')+'/*.*'
-            )
-        )
-    )
+    return list(fast_file_collector(src_dir, SRC_FILE_EXT, _recursive, exclude='.optimized'))
 
 
-def display_status( args: argparse.Namespace, src_dir: Path, files: List[Path] ) -> None:
-    ''' Get list of video files within `src_dir`
+def display_status( args: argparse.Namespace, src_dir: Path, files: List[Path], video_encoder: str ) -> None:
+    ''' Displays settings and (the first few) files to process, in a single print
     '''
-    print("="*40)
-    print("[Plex Optimizer]".center(40))
-    print("="*40)
-    print(f"Found {len(files)} files in `{src_dir}`:")
-    for idx,f in enumerate(files):
-        if idx>10:
-            print("[...]")
-            break
-        print(f">{f.relative_to(src_dir)}")
-
-    print(f"Mode: {args.mode}")
-    print(f"Output format(s): {args.format}")
+    lines = [
+        "="*40,
+        "[Plex Optimizer]".center(40),
+        "="*40,
+        f"Found {len(files)} files in `{src_dir}`:"
+    ]
+    lines += [ f">{f.relative_to(src_dir)}" for f in islice(files, 11) ]
+    if len(files) > 11:
+        lines.append("[...]")
+
+    lines += [
+        f"Mode: {args.mode}",
+        f"Output format(s): {args.format}"
+    ]
     if args.single_script:
-        print("Single script mode active")
-    print(f"Bitrate limit: {args.bitrate_limit}")
-    print("="*40)
+        lines.append("Single script mode active")
+    lines += [
+        f"Bitrate limit: {args.bitrate_limit}",
+        f"Video encoder: {video_encoder}",
+        "="*40
+    ]
+    print('\n'.join(lines))
+
+
+def plan_file(
+    converter: CodecConstraintConverter,
+    f: Path,
+    args: argparse.Namespace,
+    ladder_encoder: EncoderConfig,
+    progress: str
+) -> Optional[List[List]]:
+    ''' Plans optimization of `f` to the first possible format in `args.format`.
+
+    Returns the commands to run, or None if there is nothing to do or no format fits.
+    '''
+    for _fmt in args.format:
+        print(f"\n[{progress}] {f.name} -> {_fmt}")
+        # Make file
+        out_file = find_available_path(
+            root=f.parent,
+            base_name='.'.join([f.stem,args.mode,_fmt]),
+            file=True
+        )
+        # Plan conversion
+        conversion_commands = converter.plan_conversion(
+            file=f,
+            output_format=_fmt,
+            output_file=out_file
+        )
+        if conversion_commands==[]: # nothing to do => no script
+            return None
+        if conversion_commands: # format supports conversion
+            # Patch for MKV files
+            if _fmt=='mkv':
+                # Use mkvmerge to remux output file
+                tmp_file = out_file.with_suffix('..mkv')
+                conversion_commands += [
+                    [ f'[MOVE] "{out_file}" "{tmp_file}"' ],
+                    ['mkvmerge', '-o', out_file, tmp_file ],
+                    [ f'[DEL] "{tmp_file}"' ]
+                ]
+            # Lower resolution versions (scaled from the source's first video stream, if any)
+            if args.ladder and any(
+                stream_info.get('codec_type')=='video'
+                for stream_info in converter.get_streams_info(f).values()
+            ):
+                ladder_files = [
+                    find_available_path(
+                        root=f.parent,
+                        base_name='.'.join([f.stem,args.mode,f'{height}p',_fmt]),
+                        file=True
+                    )
+                    for height in args.ladder
+                ]
+                conversion_commands.append( ladder_command(converter, f, out_file, ladder_files, args.ladder, ladder_encoder, args.ladder_cascade) )
+            return conversion_commands
+    return None
 
 
 def main():
@@ -424,12 +729,32 @@ def main():
 
     args = get_args()
 
-    # crafting H264_EXTRA_PARAMS from CLI arguments
-    global H264_EXTRA_PARAMS
-    if args.x264_target_bitrate is None:
-        H264_EXTRA_PARAMS = [ "-preset", args.x264_preset, "-crf", args.x264_crf ]
-    else:
-        H264_EXTRA_PARAMS = [ "-preset", args.x264_preset, "-b:{out_stream}", args.x264_target_bitrate ]
+    bitrate_limit = args.bitrate_limit # in bps, parsed by argparse
+
+    # crafting h264 encoder settings from CLI arguments
+    _encoder = pick_h264_encoder(args.encoder)
+    _vbr = args.x264_rate_mode=='1pass_vbr'
+    video_encoder = EncoderConfig(
+        encoder=_encoder,
+        params=tuple(h264_rate_control_params(
+            encoder=_encoder,
+            preset=args.x264_preset,
+            crf=args.x264_crf,
+            target_bitrate=args.x264_target_bitrate,
+            vbr=_vbr
+        )),
+        two_pass=_encoder=='libx264' and args.x264_target_bitrate is not None and not _vbr
+    )
+    ladder_encoder = EncoderConfig(
+        encoder=_encoder,
+        params=tuple(h264_rate_control_params(
+            encoder=_encoder,
+            preset=args.x264_preset,
+            crf=args.x264_crf,
+            target_bitrate=None
+        )),
+        two_pass=False
+    )
 
     if args.mode=='full':
         print(FULL_MODE_WARNING)
@@ -459,52 +784,22 @@ def main():
         return
     if args.just_one:
         src_dir_files = [ src_dir_files[0] ]
+    # No more workers than files, so ffmpeg threads are shared between actual instances
+    n_workers = max(1, min(args.jobs, len(src_dir_files)))
+    # a single master script runs its commands one at a time: only one ffmpeg instance at once
+    concurrent_scripts = n_workers if args.run and not args.single_script else 1
+    _threads = ffmpeg_threads_per_invocation(n_workers=concurrent_scripts, requested=args.threads)
+    if _threads is not None:
+        video_encoder = video_encoder._replace(params=video_encoder.params + ( "-threads", str(_threads), "-filter_threads", str(_threads) ))
+        ladder_encoder = ladder_encoder._replace(params=ladder_encoder.params + ( "-threads", str(_threads) ))
 
     # Display status to user
-    display_status(args, src_dir, src_dir_files)
+    display_status(args, src_dir, src_dir_files, video_encoder.encoder)
     input("[PRESS ENTER TO CONTINUE]")
 
     # Define converter
-    format_rules = {
-        'mp4': {
-            'video': CodecRule(
-                passthrough={ 'h264' },
-                convert={ 'mjpeg', 'mpeg4', 'mpeg2video', 'hevc', 'av1', "vp9" }
-            ),
-            'audio': CodecRule(
-                passthrough={ 'mp2', 'mp3', 'aac', 'ac3', 'eac3' },
-                convert={ 'flac', 'vorbis', 'opus', 'dts' }
-            ),
-            'subtitle': CodecRule( # missing: 'dvd_subtitle'
-                passthrough={ 'mov_text' },
-                convert={ 'webvtt', 'ass', 'subrip', "hdmv_pgs_subtitle" }
-            ),
-            'attachment': CodecRule(
-                passthrough={},
-                convert={}
-            )
-        },
-        'mkv': {
-            'video': CodecRule(
-                passthrough={ 'h264' },
-                convert={ 'mjpeg', 'mpeg4', 'mpeg2video', 'hevc', 'av1', "vp9" }
-            ),
-            'audio': CodecRule(
-                passthrough={ 'mp2', 'mp3', 'aac', 'ac3', 'eac3' },
-                convert={ 'flac', 'vorbis', 'opus', 'dts' }
-            ),
-            'subtitle': CodecRule( # missing: 'dvd_subtitle'
-                passthrough={ 'subrip' },
-                convert={ 'mov_text', 'webvtt', 'ass', "hdmv_pgs_subtitle" }
-            ),
-            'attachment': CodecRule(
-                passthrough={ 'ttf' },
-                convert={}
-            )
-        }
-    }
     conversion_rules = {
-        'video': optimize_video_to_h264,
+        'video': partial(optimize_video_to_h264, encoder_config=video_encoder),
         'audio': optimize_audio_to_aac_or_ac3,
         'subtitle': optimize_subtitle_to_mov_text_or_srt
     }
@@ -514,14 +809,14 @@ def main():
         'subtitle': args.mode != 'lite', # Only drop original audio stream on `lite` mode
         'attachment': args.mode != 'lite' # Only drop attachments on `lite` mode
     }
-    _max_bitrate = args.bitrate_limit.lower().replace('k','000').replace('m','000000')
     converter = CodecConstraintConverter(
         ffmpeg_parameters=FFMPEG_PARAMETERS,
-        format_rules=format_rules,
+        format_rules=FORMAT_RULES,
         conversion_rules=conversion_rules,
         drop_unknown_streams=args.mode == 'lite',
         keep_original_streams_rules=keep_original_streams,
-        bitrate_limit=int(_max_bitrate)
+        bitrate_limit=bitrate_limit,
+        probe_cache_dir=None if args.no_cache else PROBE_CACHE_DIR
     )
 
     is_windows = Os().windows
@@ -529,70 +824,52 @@ def main():
     produce_script = converter.produce_cmd_script if is_windows else converter.produce_bash_script
     script_ext = 'bat' if is_windows else 'sh'
 
+    # Gather stream information for all files in the background
+    converter.probe_many(src_dir_files, max_workers=n_workers)
+
     # Process files
     nb_files = len(src_dir_files)
     script_files = []
-    for idx, f in enumerate(src_dir_files):
-        script_file = find_available_path(
-            root=f.parent,
-            base_name=f.with_suffix(f'.optimizer.{args.mode}.{script_ext}').name
-        )
-        for _fmt in args.format:
-            print(f"\n[{idx+1}/{nb_files}] {f.name} -> {_fmt}")
-            # Make file
-            out_file = find_available_path(
-                root=f.parent,
-                base_name='.'.join([f.stem,args.mode,_fmt]),
-                file=True
-            )
-            # Plan conversion
-            conversion_commands = converter.plan_conversion(
-                file=f,
-                output_format=_fmt,
-                output_file=out_file
-            )
-            if conversion_commands: # format supports conversion => craft script
-                # Patch for MKV files
-                if _fmt=='mkv':
-                    # Use mkvmerge to remux output file
-                    tmp_file = out_file.with_suffix('..mkv')
-                    conversion_commands += [
-                        ['REN', out_file, f'"{tmp_file.name}"' ],
-                        ['mkvmerge', '-o', out_file, tmp_file ],
-                        ['DEL', tmp_file]
-                    ]
-                # Remove temporary files when using 2-pass mode
-                if args.x264_target_bitrate:
-                    conversion_commands += [
-                        ['DEL', 'ffmpeg2pass-0.log.mbtree'],
-                        ['DEL', 'ffmpeg2pass-0.log']
-                    ]
-                # Produce script
-                produce_script(
-                    script=script_file,
-                    commands=conversion_commands
-                )
-                script_files.append(script_file)
-                break
-
+    planned_files = ( # planned lazily, as scripts are written
+        (f, plan_file(
+            converter=converter,
+            f=f,
+            args=args,
+            ladder_encoder=ladder_encoder,
+            progress=f"{idx+1}/{nb_files}"
+        ))
+        for idx, f in enumerate(src_dir_files)
+    )
+    planned_files = ( (f, commands) for f, commands in planned_files if commands )
     if args.single_script:
-        # craft a `optimize_all` script
+        # craft a `optimize_all` script: commands of all files, one section per file
         script_file = find_available_path(
             root=src_dir,
-            base_name="optimize_all.bat"
+            base_name=f"optimize_all.{script_ext}"
         )
-        commands = [['chcp 65001\n@echo off']]
-        for _script_file in script_files:
-            if is_windows:
-                commands += [[f'ECHO Processing file "{_script_file}"']]
-                commands += [[f'CALL "{_script_file}"']]
-            else:
-                commands += [[f'echo "Processing file {_script_file}"']]
-                commands += [[f'exec "{_script_file}"']]
         produce_script(
             script=script_file,
-            commands=commands
+            commands=chain.from_iterable(
+                chain([ [ f'[ECHO] Processing file "{f}"' ] ], commands)
+                for f, commands in planned_files
+            )
         )
+        script_files.append(script_file)
+    else:
+        for f, commands in planned_files:
+            script_file = find_available_path(
+                root=f.parent,
+                base_name=f.with_suffix(f'.optimizer.{args.mode}.{script_ext}').name
+            )
+            produce_script(
+                script=script_file,
+                commands=commands
+            )
+            script_files.append(script_file)
+
+    if args.run:
+        print(f"\nRunning {len(script_files)} scripts ..")
+        run_scripts(script_files, max_workers=n_workers)
 
 
 if __name__=="__main__":
@@ -1,29 +1,41 @@
-#pylint: disable=eval-used
 ''' Utilities functions
 '''
 import collections
+import ctypes
+import fnmatch
+import os
 import sys
 import re
 import json
-from typing import Iterable, Union, Any, Callable, Dict, List
+from typing import Iterable, Iterator, Union, Any, Callable, Dict, FrozenSet, List
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from subprocess import Popen, PIPE
+from string import ascii_uppercase
+from subprocess import Popen, PIPE, DEVNULL
 
 KBI_msg = "A KEYBOARDINTERRUPT WAS RAISED. THE PROGRAM WILL EXIT NOW."
-MAKE_FS_SAFE_PATTERN = re.compile( pattern=r'[\\/*?:"<>|]' )
+MAKE_FS_SAFE_TRANSLATION = str.maketrans( '', '', '\\/*?:"<>|' ) # deletes characters
+PATCH_PLACEHOLDER_PATTERN = re.compile( pattern=r'\{(\w+)\}' ) # see compile_patch
+USER_INPUT_VARIATIONS = ( int, float, str.lower ) # tried in order on user input not accepted as is
 
 #################### Execute external programs ####################
 
-def execute( command: Union[str,Iterable[str]], shell: bool = False ) -> Dict[str,str]:
+def execute( command: Union[str,Iterable[str]], shell: bool = False, decode: bool = True, capture_stderr: bool = True ) -> Dict[str,Union[str,bytes]]:
     ''' Passes command to subprocess.Popen, retrieves stdout/stderr and performs
     error management.
-    Returns a dictionnary containing stdX.
+    Returns a dictionnary containing stdX (as bytes if `decode` is False).
+    `capture_stderr`: if False, stderr is discarded (and returned empty).
     Upon command failure, prints exception and returns empty dict. '''
 
     try:
-        with Popen( command, stdout=PIPE, stderr=PIPE, shell=shell ) as process:
+        with Popen( command, stdout=PIPE, stderr=PIPE if capture_stderr else DEVNULL, shell=shell, bufsize=-1 ) as process:
             # wait and retrieve stdout/err
             _stdout, _stderr = process.communicate()
+            if _stderr is None:
+                _stderr = b''
+            if not decode:
+                return { 'stdout': _stdout, 'stderr': _stderr }
             # handle text encoding issues and return stdX
             return {
                 'stdout': _stdout.decode('utf8', errors='backslashreplace'),
@@ -33,6 +45,13 @@ def execute( command: Union[str,Iterable[str]], shell: bool = False ) -> Dict[st
         print(f"execute: Error while executing command '{command}' : {e}")
         raise
 
+def execute_many( commands: Iterable[Union[str,Iterable[str]]], max_workers: int = 8, **kwargs ) -> List[Dict[str,Union[str,bytes]]]:
+    ''' Runs `commands` concurrently (at most `max_workers` at a time) with `execute`, so their
+    process startup and run times overlap. Other arguments are passed to `execute`.
+    Returns results in the same order as `commands`. '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(partial(execute, **kwargs), commands))
+
 #################### CLI interactions ####################
 
 def __input_KBI( message: str, exit_on_KBI: bool = True ) -> str:
@@ -92,13 +111,12 @@ def user_input( prompt: str, accepted: Union[Iterable[Union[str,int]],Callable],
             return _user_input
 
         # case: processed user input is accepted
-        variations = [ 'int(_user_input)', 'float(_user_input)', '_user_input.lower()' ]
-        for variation in variations:
+        for variation in USER_INPUT_VARIATIONS:
             try:
-                __user_input = eval( variation )
+                __user_input = variation( _user_input )
                 if acceptable_UI( __user_input ):
                     return __user_input
-            except (ValueError, AttributeError):
+            except (ValueError, AttributeError, TypeError):
                 pass
 
         # case: user input is not accepted AND there is a default
@@ -130,6 +148,20 @@ def choose_from_list( choices: list, default: int ) -> Any:
     return choices[idx]
 
 
+_SUBDIRS_CACHE: Dict[Path,tuple] = {} # <directory>: (<st_mtime_ns>, <subdirectories>)
+def _cached_subdirs( cwd: Path ) -> List[Path]:
+    ''' `folder_get_subdirs`, memoized on the directory's modification time (which changes when
+    entries are added/removed/renamed), so reprompts don't enumerate the directory again.
+    One entry per directory: a stale listing is replaced, not kept alongside '''
+    mtime_ns = cwd.stat().st_mtime_ns
+    cached = _SUBDIRS_CACHE.get( cwd )
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+    sub_dirs = folder_get_subdirs( cwd )
+    _SUBDIRS_CACHE[cwd] = ( mtime_ns, sub_dirs )
+    return sub_dirs
+
+
 def cli_explorer( root_dir: Path, allow_mkdir: bool = True, windows_behavior: bool = True ) -> Path:
     ''' Allows for the user to explore directories to select one.
     Note: windows-specific behavior
@@ -139,19 +171,25 @@ def cli_explorer( root_dir: Path, allow_mkdir: bool = True, windows_behavior: bo
     cwd = _root_dir
     NEW_FOLDER_TEXT = '<Make new folder here>'
 
+    # selection lists are only rebuilt when `cwd` or its listing changed since the previous iteration
+    prev_cwd, sub_dirs = object(), None
     while True:
         # Craft selection list
-        sub_dirs = folder_get_subdirs( cwd ) if cwd else windows_list_logical_drives()
-        selection_list = [ d.name if 0<len(d.name) else str(d) for d in sub_dirs ]
-        extra_options = []
-        cwd_has_parents = cwd and len(cwd.parents)>0
-        windows_but_not_displaying_drives = windows_behavior and cwd is not None
-        if cwd_has_parents or windows_but_not_displaying_drives:
-            extra_options.append('..')
-        if cwd:
-            extra_options.append('.')
-            if allow_mkdir:
-                extra_options.append(NEW_FOLDER_TEXT)
+        _sub_dirs = _cached_subdirs( cwd ) if cwd else windows_list_logical_drives()
+        if _sub_dirs is not sub_dirs:
+            sub_dirs = _sub_dirs
+            selection_list = [ d.name if 0<len(d.name) else str(d) for d in sub_dirs ]
+        if cwd != prev_cwd:
+            prev_cwd = cwd
+            extra_options = []
+            cwd_has_parents = cwd and len(cwd.parents)>0
+            windows_but_not_displaying_drives = windows_behavior and cwd is not None
+            if cwd_has_parents or windows_but_not_displaying_drives:
+                extra_options.append('..')
+            if cwd:
+                extra_options.append('.')
+                if allow_mkdir:
+                    extra_options.append(NEW_FOLDER_TEXT)
 
         # ask user
         print(f"cwd : {cwd}")
@@ -179,6 +217,7 @@ def cli_explorer( root_dir: Path, allow_mkdir: bool = True, windows_behavior: bo
                     continue
                 # Create it and move to it
                 new_dir.mkdir()
+                _SUBDIRS_CACHE.clear() # some file systems have coarse mtime resolution
                 cwd = new_dir
                 break
         else:
@@ -199,14 +238,6 @@ def find_available_path( root: Path, base_name: str, file: bool = True ) -> Path
 
     `file`: True if X is a file, False if it is a directory
     '''
-    # Helper function: makes suffixes for already existing files/directories
-    def suffixes() -> str:
-        yield ''
-        idx=0
-        while True:
-            idx+=1
-            yield f" ({idx})"
-
     # automatic '{suffix}' placement
     if '{suffix}' not in base_name:
         # print(f"base_name='{base_name}'", end='')
@@ -217,25 +248,44 @@ def find_available_path( root: Path, base_name: str, file: bool = True ) -> Path
             base_name = base_name[:ext_idx] + '{suffix}' + base_name[ext_idx:]
         # print(f" -> '{base_name}', ext_idx={ext_idx}")
 
-    # Iterate over candidate paths until an unused one is found
     safe_base_name = make_FS_safe( base_name )
 
-    for _suffix in suffixes():
-        _object = root / safe_base_name.format(suffix=_suffix)
-        if file and not _object.is_file(): # file mode
-            return _object
-        if not file and not _object.is_dir(): # directory mode
-            return _object
+    # Helper function: candidate path for index `idx` (0: no suffix)
+    def candidate( idx: int ) -> Path:
+        return root / safe_base_name.format(suffix=f" ({idx})" if idx else '')
+
+    def exists( idx: int ) -> bool:
+        _object = candidate( idx )
+        return _object.is_file() if file else _object.is_dir()
+
+    if not exists( 0 ):
+        return candidate( 0 )
+
+    # Exponential then binary search for an unused index, in O(log N) checks instead of N
+    # (indexes are assumed used contiguously from 1, else any unused index may be found)
+    lo, hi = 0, 1
+    while exists( hi ):
+        lo, hi = hi, hi*2
+    # invariant: `lo` used (or 0), `hi` unused
+    while lo+1 < hi:
+        mid = (lo+hi)//2
+        if exists( mid ):
+            lo = mid
+        else:
+            hi = mid
+    return candidate( hi )
 
 
 def folder_get_subdirs( root_dir: Path ) -> List[Path]:
     ''' Return a list of first level subdirectories '''
     assert root_dir.is_dir()
-    return [
-        item
-        for item in root_dir.resolve().iterdir()
-        if item.is_dir() and (not '$RECYCLE.BIN' in item.parts)
-    ]
+    # os.scandir: entry types come from the directory listing, no `stat` call per entry
+    with os.scandir( root_dir.resolve() ) as entries:
+        return [
+            Path( entry.path )
+            for entry in entries
+            if entry.is_dir( follow_symlinks=False ) and entry.name != '$RECYCLE.BIN'
+        ]
 
 
 def make_FS_safe( s: str ) -> str:
@@ -245,11 +295,7 @@ def make_FS_safe( s: str ) -> str:
 
     Note: OS/FS agnostic, applies a simple filter on characters: ``\\, /, *, ?, :, ", <, >, |``
     '''
-    return re.sub(
-        pattern=MAKE_FS_SAFE_PATTERN,
-        repl="",
-        string=s
-    )
+    return s.translate( MAKE_FS_SAFE_TRANSLATION )
 
 
 def windows_list_logical_drives() -> List[Path]:
@@ -258,75 +304,151 @@ def windows_list_logical_drives() -> List[Path]:
     Warning: Only works on Windows !
     '''
 
-    # uses a windows shell command to list drives
-    command = [ 'wmic', 'logicaldisk', 'get', 'name' ]
-    stdout = execute( command )['stdout']
+    # bitmask of available drives: bit 0 is A:, bit 1 is B:, ... (single system call, no `wmic` process)
+    drives_bitmask = ctypes.windll.kernel32.GetLogicalDrives()
 
-    def return_cleaned( l ):
-        for item in l:
-            if len(item) < 2:
-                continue
-            if item[0].isupper() and item[1] == ':':
-                # Bugfix : the '<driveletter>:' format was resolving to CWD when driveletter==CWD's driveletter.
-                # This seems to be an expected Windows behavior. Fix: switch to '<driveletter>:\\' format, whis is more appropriate.
-                yield Path(item[:2]+'\\').resolve()
+    # Bugfix : the '<driveletter>:' format was resolving to CWD when driveletter==CWD's driveletter.
+    # This seems to be an expected Windows behavior. Fix: switch to '<driveletter>:\\' format, whis is more appropriate.
+    return [
+        Path(f'{letter}:\\')
+        for idx, letter in enumerate(ascii_uppercase)
+        if drives_bitmask >> idx & 1
+    ]
 
-    drives = list( return_cleaned(stdout.splitlines()) )
-    return drives
+
+def iter_files( root: Path, pattern: str = '**/*.*' ) -> Iterator[Path]:
+    ''' Yields files within `root` matching `pattern`, a `pathlib.glob`-like pattern: a name pattern
+    (eg: `*.mkv`), optionally prefixed by `**/` to also search subdirectories (eg: `**/*.mkv`).
+    Uses `os.walk` (`os.scandir`) : file types are known from directory listings, so no `stat` call
+    per file; trash directories (`$RECYCLE.BIN`) are pruned, not walked. '''
+    recursive = pattern.startswith( '**/' )
+    name_pattern = pattern[3:] if recursive else pattern
+    if '/' in name_pattern:
+        # patterns with intermediate directories: not worth reimplementing glob
+        yield from ( item for item in root.glob( pattern ) if '$RECYCLE.BIN' not in str( item ) and item.is_file() )
+        return
+
+    for dirpath, dirnames, filenames in os.walk( root ):
+        # 11/11/2020 BUGFIX : was collecting files in trash like a cyber racoon
+        dirnames[:] = [ d for d in dirnames if d != '$RECYCLE.BIN' ] if recursive else []
+        _dirpath = Path( dirpath )
+        for filename in fnmatch.filter( filenames, name_pattern ):
+            yield _dirpath / filename
 
 
 def file_collector( root: Path, pattern: Union[str,Iterable[str]] = '**/*.*' ) -> List[Path]:
-    ''' Easy to use tool to collect files matching a pattern (recursive or not), using pathlib.glob.
+    ''' Easy to use tool to collect files matching a pattern (recursive or not), using `iter_files`.
     Collect files matching given pattern(s) '''
     assert root.is_dir()
-    root.resolve()
     #log.debug( "root=%s", root )
 
-    def collect( _pattern: str ) -> List[Path]:
-        # 11/11/2020 BUGFIX : was collecting files in trash like a cyber racoon
-        _files = [
-            item
-            for item in root.glob( _pattern )
-            if item.is_file() and (not '$RECYCLE.BIN' in item.parts)
-        ]
-        # log.debug( "\t'%s': Found %s files in %s", _pattern, len(_files), root )
-        return _files
-
     files = []
     if isinstance( pattern, str ):
-        files = collect( pattern )
+        files = list( iter_files( root, pattern ) )
     elif isinstance( pattern, collections.abc.Iterable ):
         patterns = pattern
         assert 0 < len(patterns)
         for p in patterns:
-            files.extend( collect(p) )
+            files.extend( iter_files( root, p ) )
     else:
         raise ValueError(f"FileCollector: 'pattern' ({pattern}) must be an Iterable or a string, but is a {type(pattern)}")
 
     return files
 
 
+def fast_file_collector( root: Path, exts: FrozenSet[str], recursive: bool, exclude: str = None ) -> Iterator[Path]:
+    ''' Yields files within `root` whose extension (case insensitive, without dot) is in `exts`
+    and whose name doesn't contain `exclude`. Trash directories and symlinked directories are
+    skipped. Filtering is done on names, before any `stat` call or Path is built.
+    '''
+    dirs = [ root ]
+    while dirs:
+        sub_dirs = []
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive and entry.name!='$RECYCLE.BIN':
+                        sub_dirs.append(entry.path)
+                    continue
+                _, dot, ext = entry.name.rpartition('.')
+                if dot and ext.lower() in exts and (exclude is None or exclude not in entry.name) and entry.is_file():
+                    yield Path(entry.path)
+        dirs.extend(reversed(sub_dirs)) # same order as a recursive walk
+
+
 def dump_json( obj, file ):
     ''' Dump object (preferably dict or list containing basic types) to JSON file
     '''
-    file.write_text(
-        json.dumps(obj, indent=2, default=str),
-        encoding='utf8',
-        errors='ignore'
-    )
+    with file.open('w', encoding='utf8', errors='ignore') as fp:
+        json.dump(obj, fp, indent=2, default=str)
+
 
+def prepare_patch( patch: dict ) -> Dict[str,str]:
+    ''' Prepares a patch for `patch_string`, once for any number of strings to patch:
+    non-str replacements (eg: Path) are quoted.
 
-def patch_string( s: str, patch: dict ) -> str:
+    `patch` must be a dict with entries:
+        <to_replace:str>:<replacement:Union[str,Path]>
+    '''
+    return {
+        to_replace: replacement if isinstance(replacement, str) else f'"{replacement}"'
+        for to_replace, replacement in patch.items()
+    }
+
+
+def patch_string( s: str, patch: Dict[str,str] ) -> str:
     ''' Applies a patch on string s
     Returns s if not a str or no patch could be applied.
 
     `patch` must be a dict with entries:
-        <to_replace:str>:<replacement:Union[str,Path]>
+        <to_replace:str>:<replacement:str>
+    eg: as returned by `prepare_patch`
     '''
 
     if not isinstance(s, str):
         return s
     _s = s
     for to_replace, replacement in patch.items():
-        _s = _s.replace(to_replace, replacement if isinstance(replacement, str) else f'"{replacement}"')
+        _s = _s.replace(to_replace, replacement)
     return _s
+
+
+class PatchContext(dict):
+    ''' Placeholder values for patches compiled with `compile_patch`. Like with `patch_string`,
+    non-str values (eg: Path) are quoted and unknown placeholders are left untouched.
+    eg: PatchContext(in_stream='1', in_file=Path('a.mkv'))
+    '''
+    def __init__( self, **values ) -> None:
+        super().__init__(prepare_patch(values))
+
+    def __missing__( self, key: str ) -> str:
+        return '{' + key + '}'
+
+
+def compile_patch( s: Any ) -> Any:
+    ''' Prepares `s` for repeated patching: returns `s` if it isn't a str containing
+    placeholders (eg: '{in_stream}'), else a callable taking a PatchContext.
+    Only `{name}` tokens are placeholders: other braces (eg: in filter expressions) are kept as is.
+    '''
+    if not isinstance(s, str):
+        return s
+    parts = PATCH_PLACEHOLDER_PATTERN.split(s) # literal text, placeholder name, literal text, ...
+    if len(parts) == 1:
+        return s
+    literals, names = parts[0::2], parts[1::2]
+
+    def patch( context: PatchContext ) -> str:
+        return literals[0] + ''.join(
+            context[name] + literal
+            for name, literal in zip(names, literals[1:])
+        )
+    return patch
+
+
+def apply_patch( compiled: List[Any], context: PatchContext ) -> List[Any]:
+    ''' Applies `context` on items returned by `compile_patch`
+    '''
+    return [
+        s(context) if callable(s) else s
+        for s in compiled
+    ]
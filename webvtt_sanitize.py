@@ -23,12 +23,14 @@ Warning:
 
 from pathlib import Path
 from typing import List
+import os
 import re
 import json
 import argparse
 
 
 TIMECODE_PATTERN = re.compile(r"(\d{2}:\d{2}\.\d{3}) \-\-> (\d{2}:\d{2}\.\d{3})")
+DEBUG = os.environ.get('WEBVTT_SANITIZE_DEBUG', '0') != '0' # print fused subtitles
 
 
 def get_args() -> argparse.Namespace:
@@ -49,22 +51,20 @@ def ms_to_timecode(ms: int) -> str:
 
 def timecode_to_ms(timecode: str) -> int:
     ''' Conversion <timecode_txt:str> -> <timecode_ms:int>
+    Timecode format is fixed (MM:SS.mmm, see TIMECODE_PATTERN), so fields are sliced.
     '''
-    components = [
-        int(x)
-        for x in re.split(r"[\.:]+", timecode)
-    ]
-    assert len(components)==3
-    return components[0] * 60_000 + components[1] * 1000 + components[2]
+    return int(timecode[0:2]) * 60_000 + int(timecode[3:5]) * 1000 + int(timecode[6:9])
 
 
 class SubtitleUnit:
     ''' Represents a unique subtitle, with its text and timecodes
     '''
+    __slots__ = ('a', 'b', 'txt') # no per-instance __dict__: files can have many subtitles
+
     def __init__(self, timecode: str, text: List[str]):
         ''' init with timecode conversion
         '''
-        begin, end = re.split(r" \-\-> ", timecode)
+        begin, end = timecode.split(" --> ", 1)
         begin_ms, end_ms = timecode_to_ms(begin), timecode_to_ms(end)
         assert begin_ms < end_ms
         self.a, self.b = begin_ms, end_ms
@@ -92,9 +92,14 @@ class SubtitleUnit:
     def h_collision(self, other_a: int, other_b: int) -> bool:
         ''' Returns True if two subtitles are concurrent
         '''
-        if self.a <= other_a:
-            return 0 < self.b - other_a
-        return 0 < other_b - self.a
+        # intervals [a,b[ with a<b overlap iff each starts before the other ends
+        return self.a < other_b and other_a < self.b
+
+
+    def as_dict(self) -> dict:
+        ''' Debug: attributes as a dict (no __dict__ because of __slots__)
+        '''
+        return {k: getattr(self, k) for k in self.__slots__}
 
 
     @property
@@ -108,17 +113,32 @@ class SubtitleUnit:
     def subtitles_to_str(cls, subtitles: List['SubtitleUnit']) -> str:
         ''' Debug: print a list of subtitles
         '''
-        return ', '.join(json.dumps(s.__dict__) for s in subtitles)
+        return ', '.join(json.dumps(s.as_dict(), separators=(',',':')) for s in subtitles)
 
 
     @classmethod
     def fuse_subtitles(cls, subtitles):
         ''' Merge N subtitles into M non-concurrent sutitles
         '''
-        ts = list(sorted(set(s.a for s in subtitles).union(set(s.b for s in subtitles))))
+        # Sweep over cut points: subtitles are displayed from their start to their end;
+        # `displayed` is keyed by position in `subtitles`, to keep their order
+        starts_at, ends_at = {}, {}
+        for k, s in enumerate(subtitles):
+            starts_at.setdefault(s.a, []).append(k)
+            ends_at.setdefault(s.b, []).append(k)
+        # cut points: keys of the above, deduplicated by a single set union
+        ts = sorted(starts_at.keys() | ends_at.keys())
+        # subtitles sorted by start (as given by `straighten_timeline`) are added to `displayed`
+        # in position order, so its insertion order needs no sorting at each cut point
+        in_order = all(s.a <= t.a for s, t in zip(subtitles, subtitles[1:]))
+        displayed = {}
         subs = []
         for a,b in zip(ts, ts[1:]):
-            displayed_subs = [s for s in subtitles if s.h_collision(a,b)]
+            for k in ends_at.get(a, ()):
+                del displayed[k]
+            for k in starts_at.get(a, ()):
+                displayed[k] = subtitles[k]
+            displayed_subs = list(displayed.values()) if in_order else [ displayed[k] for k in sorted(displayed) ]
             assert displayed_subs, f"No displayable subtitle in [{a},{b}] for {SubtitleUnit.subtitles_to_str(subtitles)}"
             text = []
             for idx, s in enumerate(reversed(displayed_subs)):
@@ -147,26 +167,32 @@ class SubtitleStream:
     def straighten_timeline(self, subtitles: List[SubtitleUnit]):
         ''' Corrects for incorrectly sorted or concurrent subtitles
         '''
-        _subtitles = list(sorted(subtitles))
-        nb_subs = len(_subtitles)
         subtitles_ok = []
-        i = 0
-        while i < nb_subs:
-            if not _subtitles[i].collision(_subtitles[i+1]):
-                subtitles_ok.append(_subtitles[i])
-                i += 1
-                continue
 
-            # collision
-            collided_subs = [ _subtitles[i], _subtitles[i+1] ]
-            j = i+2
-            while j < nb_subs and any(_subtitles[k].collision(_subtitles[j]) for k in range(i,j)):
-                collided_subs.append( _subtitles[j] )
-                j += 1
-            fused_subs = SubtitleUnit.fuse_subtitles(collided_subs)
-            print(f"Fusing subtitles: {SubtitleUnit.subtitles_to_str(collided_subs)}\n into: {SubtitleUnit.subtitles_to_str(fused_subs)}")
+        def flush(group: List[SubtitleUnit]) -> None:
+            if len(group) == 1:
+                subtitles_ok.append(group[0])
+                return
+            fused_subs = SubtitleUnit.fuse_subtitles(group)
+            if DEBUG:
+                print(f"Fusing subtitles: {SubtitleUnit.subtitles_to_str(group)}\n into: {SubtitleUnit.subtitles_to_str(fused_subs)}")
             subtitles_ok.extend(fused_subs)
-            i = j
+
+        # Single pass: subtitles are sorted by start time, so a subtitle collides with
+        # the current group iff it starts before the group's latest end
+        group, group_end = [], None
+        for sub in sorted(subtitles):
+            a, b = sub.a, sub.b
+            if group and a < group_end:
+                group.append(sub)
+                if group_end < b:
+                    group_end = b
+                continue
+            if group:
+                flush(group)
+            group, group_end = [sub], b
+        if group:
+            flush(group)
 
         return subtitles_ok
 
@@ -176,49 +202,46 @@ class SubtitleStream:
         ''' Read SubtitleStream from a .vtt file
         '''
         subtitles = []
-        lines = f.read_text(encoding='utf8').splitlines()
-
-        # Webvtt files begin with "WEBVTT\n"
-        assert lines[0]=='WEBVTT'
+        # local names for the per-line loop
+        tc_match, subtitles_append, subtitle_unit = TIMECODE_PATTERN.match, subtitles.append, SubtitleUnit
 
-        # subtitles begin at line index 2
         # each line can be: timecode, blank or subtitle text
         s_timecode, s_text, sep = None, [], 0
 
-        def null_generator( it ):
-            for x in it:
-                yield x
-            while True:
-                yield None
-
-        for line in null_generator(lines[2:]):
-
-            # case: end of file => append current subtitle and return
-            if line is None:
-                if s_timecode is not None:
-                    subtitles.append(SubtitleUnit(s_timecode, s_text))
-                break
-
-            # case: new timecode => first or new subtitle
-            if re.match(TIMECODE_PATTERN, line):
-                if s_timecode is not None:
-                    subtitles.append(SubtitleUnit(s_timecode, s_text))
-                s_timecode = line
-                s_text = []
-                sep = 0
-                continue
-
-            # case: empty line => separator or "\n" in subtitle text
-            if line == '':
-                sep += 1
-                continue
-
-            # case: other content => subtitle text
-            for _ in range(sep):
-                print(f"Litteral line break found in subtitle text after '{s_text}'")
-                s_text.append('<br/>')
-                sep = 0
-            s_text.append(line.strip())
+        # lines are read one at a time, rather than the whole file at once
+        with f.open('r', encoding='utf8') as fp:
+            # Webvtt files begin with "WEBVTT\n"
+            assert next(fp, '').rstrip('\n')=='WEBVTT'
+
+            # subtitles begin at line index 2
+            next(fp, None)
+            for line in fp:
+                line = line.rstrip('\n')
+
+                # case: new timecode => first or new subtitle
+                if tc_match(line):
+                    if s_timecode is not None:
+                        subtitles_append(subtitle_unit(s_timecode, s_text))
+                    s_timecode = line
+                    s_text = []
+                    sep = 0
+                    continue
+
+                # case: empty line => separator or "\n" in subtitle text
+                if line == '':
+                    sep += 1
+                    continue
+
+                # case: other content => subtitle text
+                for _ in range(sep):
+                    print(f"Litteral line break found in subtitle text after '{s_text}'")
+                    s_text.append('<br/>')
+                    sep = 0
+                s_text.append(line.strip())
+
+        # end of file => append current subtitle
+        if s_timecode is not None:
+            subtitles_append(subtitle_unit(s_timecode, s_text))
 
         return SubtitleStream(subtitles)
 
@@ -227,7 +250,7 @@ class SubtitleStream:
         ''' Debug: output as json string
         '''
         obj = [
-            s.__dict__
+            s.as_dict()
             for s in self.subtitles
         ]
         return json.dumps(obj, indent=2)